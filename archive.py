@@ -0,0 +1,457 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import functools
+import os
+import struct
+import time
+import zlib
+
+
+# Size of the blocks read from member files
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Sizes and offsets from this value on need ZIP64 records
+ZIP64_LIMIT = 0xFFFFFFFF
+
+# Member counts from this value on need ZIP64 records
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Members are deflated in chunks of this size. Every chunk is
+# compressed on its own and ends on a byte boundary (like pigz does),
+# so the chunks can be compressed in parallel and concatenated.
+DEFLATE_CHUNK_SIZE = 1024 * 1024
+
+# Chunks compressed ahead of the one being sent, per worker
+CHUNKS_AHEAD = 2
+
+# Without a measuring pass the compressed size of deflated members is
+# only known once they are sent, they get ZIP64 records if their size
+# times this (deflate grows incompressible data a little) reaches
+# ZIP64_LIMIT
+DEFLATE_ZIP64_MARGIN = 1.05
+
+# Members are sampled before they are deflated, members whose samples
+# don't shrink below this ratio (compressed EXRs, videos, zip files)
+# are stored
+COMPRESSIBLE_RATIO = 0.9
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 4
+
+# General purpose flags: the CRC and sizes follow the data in a data
+# descriptor, names are UTF-8
+FLAG_DATA_DESCRIPTOR = 0x0008
+FLAG_UTF8 = 0x0800
+
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+DATA_DESCRIPTOR = struct.Struct("<IIII")
+ZIP64_DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+
+
+def dos_time(timestamp):
+    """ Returns the MS-DOS time and date of a unix timestamp """
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def _gf2_times(matrix, vector):
+    result = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return result
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+@functools.lru_cache(maxsize=8)
+def _zeros_operator(length):
+    """ Returns the matrix that advances a CRC-32 over length zero
+        bytes, see zlib's crc32_combine() """
+    # one zero bit
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    # two and four zero bits
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    operator = [1 << n for n in range(32)]
+    while length:
+        even = _gf2_square(odd)
+        if length & 1:
+            operator = [_gf2_times(even, row) for row in operator]
+        length >>= 1
+        if not length:
+            break
+        odd = _gf2_square(even)
+        if length & 1:
+            operator = [_gf2_times(odd, row) for row in operator]
+        length >>= 1
+    return operator
+
+
+def crc32_combine(crc1, crc2, length2):
+    """ Returns the CRC-32 of two concatenated blocks from their CRCs and
+        the length of the second block """
+    return _gf2_times(_zeros_operator(length2), crc1) ^ crc2
+
+
+def read_chunk(path, offset, length):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise OSError(f"{path} changed while it was read")
+    return data
+
+
+def deflate_chunk(path, offset, length, level, final, measure=False):
+    """ Deflates a chunk of the file at path, returns the compressed
+        data (or only its length if measure) and the chunk's CRC-32
+
+        Runs in a worker of the ZipStream's executor """
+    data = read_chunk(path, offset, length)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+    return len(compressed) if measure else compressed, zlib.crc32(data)
+
+
+def is_compressible(path, size, level):
+    """ Compresses a few samples of the file at path, returns whether
+        they shrink enough to be worth deflating """
+    if size == 0:
+        return False
+    sample_size = min(SAMPLE_SIZE, size)
+    step = (size - sample_size) // max(SAMPLE_COUNT - 1, 1)
+    compressed = 0
+    with open(path, "rb") as f:
+        for i in range(SAMPLE_COUNT):
+            f.seek(i * step)
+            sample = f.read(sample_size)
+            compressed += len(zlib.compress(sample, level))
+    return compressed < COMPRESSIBLE_RATIO * sample_size * SAMPLE_COUNT
+
+
+def ordered_results(executor, calls, ahead):
+    """ Yields the results of calls, (function, args) tuples, in order
+        while keeping up to ahead of them running in executor, or runs
+        them one after another without an executor """
+    if executor is None:
+        for function, args in calls:
+            yield function(*args)
+        return
+    pending = []
+    calls = iter(calls)
+    try:
+        while True:
+            while len(pending) < ahead:
+                call = next(calls, None)
+                if call is None:
+                    break
+                pending.append(executor.submit(call[0], *call[1]))
+            if not pending:
+                return
+            yield pending.pop(0).result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class ZipMember():
+    """ A file in a ZipStream, added as arcname """
+
+    def __init__(self, path, arcname):
+        self.path = path
+        # ZIP uses forward slashes on every platform
+        self.arcname = arcname.replace(os.sep, "/").lstrip("/")
+        st = os.stat(path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.method = ZIP_STORED
+        self.compressed_size = self.size
+        self.crc = 0
+        self.offset = None
+        # compressed size found by a measuring pass
+        self.measured_size = None
+
+    def chunks(self):
+        """ Yields the offset, length and whether it is the last one of
+            every chunk of the file """
+        if self.size == 0:
+            yield 0, 0, True
+        for offset in range(0, self.size, DEFLATE_CHUNK_SIZE):
+            length = min(DEFLATE_CHUNK_SIZE, self.size - offset)
+            yield offset, length, offset + length == self.size
+
+    @property
+    def zip64(self):
+        if self.method == ZIP_DEFLATED and self.measured_size is None:
+            return self.size * DEFLATE_ZIP64_MARGIN >= ZIP64_LIMIT
+        return self.size >= ZIP64_LIMIT or \
+            self.compressed_size >= ZIP64_LIMIT
+
+    def calls(self, level, measure=False):
+        """ Returns the chunk calls that deflate this member and compute
+            its CRC, measure only returns the compressed sizes """
+        return [(deflate_chunk,
+                 (self.path, offset, length, level, final, measure))
+                for offset, length, final in self.chunks()]
+
+    def data(self):
+        """ Yields the data of the member as it is stored and computes
+            its CRC """
+        self.crc = 0
+        with open(self.path, "rb") as f:
+            remaining = self.size
+            while remaining > 0:
+                block = f.read(min(READ_BLOCK_SIZE, remaining))
+                if not block:
+                    raise OSError(f"{self.path} changed while it was read")
+                remaining -= len(block)
+                self.crc = zlib.crc32(block, self.crc)
+                yield block
+
+    def local_header(self):
+        # the CRC and sizes are left out, they follow in the data
+        # descriptor
+        name = self.arcname.encode("utf-8")
+        extra = b""
+        size = 0
+        if self.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            size = ZIP64_LIMIT
+        modified, date = dos_time(self.mtime)
+        return LOCAL_HEADER.pack(
+            0x04034b50, VERSION_ZIP64 if self.zip64 else VERSION_DEFAULT,
+            FLAG_UTF8 | FLAG_DATA_DESCRIPTOR, self.method, modified, date,
+            0, size, size, len(name), len(extra)) + name + extra
+
+    def data_descriptor(self):
+        if self.zip64:
+            return ZIP64_DATA_DESCRIPTOR.pack(
+                0x08074b50, self.crc, self.compressed_size, self.size)
+        return DATA_DESCRIPTOR.pack(0x08074b50, self.crc,
+                                    self.compressed_size, self.size)
+
+    @property
+    def data_descriptor_size(self):
+        return ZIP64_DATA_DESCRIPTOR.size if self.zip64 \
+            else DATA_DESCRIPTOR.size
+
+    def central_header(self):
+        name = self.arcname.encode("utf-8")
+        fields = []
+        size = self.size
+        compressed_size = self.compressed_size
+        offset = self.offset
+        if self.zip64:
+            fields += [size, compressed_size]
+            size = compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b""
+        if fields:
+            extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields),
+                                *fields)
+        version = VERSION_ZIP64 if extra else VERSION_DEFAULT
+        modified, date = dos_time(self.mtime)
+        return CENTRAL_HEADER.pack(
+            0x02014b50, version, version,
+            FLAG_UTF8 | FLAG_DATA_DESCRIPTOR, self.method,
+            modified, date, self.crc, compressed_size, size, len(name),
+            len(extra), 0, 0, 0, 0o100644 << 16, offset) + name + extra
+
+
+class ZipStream():
+    """ ZIP archive of files that is generated while it is read, nothing
+        but a few blocks is held in memory
+
+        The CRC-32 of every member is computed while it is sent and
+        written in a data descriptor after its data, so every member is
+        read once. Without compression the length of the archive is
+        known before its first byte is read, so it can be uploaded with
+        a Content-Length header.
+
+        With a compression level, members whose samples compress well
+        are deflated, the others are stored. With measure, deflated
+        members are compressed twice, once by scan() to learn their
+        compressed size and once while the archive is read, and the
+        length stays known in advance. Without it they are compressed
+        once and the length of the archive is only known once it was
+        read. Chunks are compressed in executor (a concurrent.futures
+        executor) in parallel and put back in order. ZIP64 records are
+        added where sizes, offsets or the member count need them.
+
+        The stream has a file-like read() and, once scan() found its
+        length, a len attribute with the number of bytes left, like the
+        files the MultipartEncoder accepts. bytes_read counts the bytes
+        read from members, out of data_size. """
+
+    def __init__(self, members, level=0, executor=None, workers=1,
+                 measure=True):
+        """ members is a list of (path, arcname) tuples, level the zlib
+            compression level or 0 to store all members, workers the
+            number of workers of executor and measure whether deflated
+            members are measured before they are sent """
+        self.members = [ZipMember(path, arcname)
+                        for path, arcname in members]
+        self.level = level
+        self.measure = measure
+        self.executor = executor
+        self.ahead = max(workers, 1) * CHUNKS_AHEAD
+        self.size = None
+        self.data_size = sum(member.size for member in self.members)
+        self.bytes_read = 0
+        self._scanned = False
+        self._position = 0
+        self._buffer = b""
+        self._blocks = None
+
+    def scan(self):
+        """ Chooses how members are stored and computes the layout of the
+            archive, reading samples of the members and, with measure,
+            deflating the members that are deflated
+
+            Returns the size of the archive in bytes, or None if members
+            are deflated without measure, then size is set once the
+            archive was read """
+        if self._scanned:
+            return self.size
+        self._scanned = True
+        for member in self.members:
+            if self.level and is_compressible(member.path, member.size,
+                                              self.level):
+                member.method = ZIP_DEFLATED
+        deflated = [member for member in self.members
+                    if member.method == ZIP_DEFLATED]
+        if deflated and not self.measure:
+            return None
+        calls = [(member, call) for member in deflated
+                 for call in member.calls(self.level, measure=True)]
+        results = ordered_results(self.executor,
+                                  [call for member, call in calls],
+                                  self.ahead)
+        for member in deflated:
+            member.measured_size = 0
+        for (member, call), (compressed, crc) in zip(calls, results):
+            member.measured_size += compressed
+        for member in deflated:
+            member.compressed_size = member.measured_size
+        offset = 0
+        for member in self.members:
+            member.offset = offset
+            offset += len(member.local_header()) + \
+                member.compressed_size + member.data_descriptor_size
+        self._directory_offset = offset
+        self._directory_size = sum(len(member.central_header())
+                                   for member in self.members)
+        self.size = offset + self._directory_size + len(self._end_records())
+        return self.size
+
+    @property
+    def len(self):
+        if self.scan() is None:
+            return None
+        return self.size - self._position
+
+    def _end_records(self):
+        count = len(self.members)
+        offset = self._directory_offset
+        size = self._directory_size
+        records = b""
+        if count >= ZIP64_COUNT_LIMIT or offset >= ZIP64_LIMIT or \
+                size >= ZIP64_LIMIT:
+            zip64_offset = offset + size
+            records += ZIP64_END_RECORD.pack(
+                0x06064b50, ZIP64_END_RECORD.size - 12, VERSION_ZIP64,
+                VERSION_ZIP64, 0, 0, count, count, size, offset)
+            records += ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_offset, 1)
+            count = min(count, ZIP64_COUNT_LIMIT)
+            offset = min(offset, ZIP64_LIMIT)
+            size = min(size, ZIP64_LIMIT)
+        return records + END_RECORD.pack(0x06054b50, 0, 0, count, count,
+                                         size, offset, 0)
+
+    def __iter__(self):
+        self.scan()
+        offset = 0
+        for member in self.members:
+            member.offset = offset
+            header = member.local_header()
+            offset += len(header)
+            yield header
+            if member.method == ZIP_DEFLATED:
+                member.crc = 0
+                member.compressed_size = 0
+                calls = member.calls(self.level)
+                for (function, args), (compressed, crc) in zip(
+                        calls, ordered_results(self.executor, calls,
+                                               self.ahead)):
+                    member.crc = crc32_combine(member.crc, crc, args[2])
+                    member.compressed_size += len(compressed)
+                    self.bytes_read += args[2]
+                    yield compressed
+                if member.measured_size is not None and \
+                        member.compressed_size != member.measured_size:
+                    raise OSError(f"{member.path} changed while it was "
+                                  "read")
+            else:
+                for block in member.data():
+                    self.bytes_read += len(block)
+                    yield block
+            offset += member.compressed_size
+            descriptor = member.data_descriptor()
+            offset += len(descriptor)
+            yield descriptor
+        directory = b"".join(member.central_header()
+                             for member in self.members)
+        self._directory_offset = offset
+        self._directory_size = len(directory)
+        end_records = self._end_records()
+        self.size = offset + len(directory) + len(end_records)
+        yield directory
+        yield end_records
+
+    def read(self, size=-1):
+        if self._blocks is None:
+            self._blocks = iter(self)
+        while size < 0 or len(self._buffer) < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buffer += block
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._position += len(data)
+        return data
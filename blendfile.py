@@ -0,0 +1,507 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Reads .blend files without Blender, so it must only use the standard
+# library.
+
+
+import bisect
+import collections
+import mmap
+import os
+import struct
+import zlib
+
+try:
+    # Python 3.14+
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    zstd = None
+
+# Errors of the decompressors on corrupt data
+DECOMPRESSION_ERRORS = (zlib.error,)
+if zstd is not None:
+    DECOMPRESSION_ERRORS += (zstd.ZstdError,)
+elif zstandard is not None:
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Blender writes zstd files in the seekable format, which ends with a
+# table of the compressed and decompressed size of every frame
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+ZSTD_SEEK_TABLE_FOOTER = struct.Struct("<IBI")
+
+# Size of the compressed blocks read by stream_datablocks, compressed
+# sizes are interpolated within a block
+STREAM_BLOCK_SIZE = 256 * 1024
+
+# Bytes kept of every ID block by stream_datablocks to read its name
+# once the SDNA (at the end of the file) is known
+ID_PREFIX_SIZE = 512
+
+
+class BlendFileError(Exception):
+    pass
+
+
+BlockHeader = collections.namedtuple(
+    "BlockHeader", ["code", "size", "old", "sdna_index", "count", "offset"])
+
+Field = collections.namedtuple(
+    "Field", ["type", "name", "offset", "size", "is_pointer", "count"])
+
+Datablock = collections.namedtuple(
+    "Datablock", ["code", "name", "block", "size", "end"])
+
+
+class Struct():
+    """ A struct of the file's SDNA, fields maps field names (without
+        pointer and array decoration) to Field tuples """
+
+    def __init__(self, name, size, fields):
+        self.name = name
+        self.size = size
+        self.fields = fields
+
+
+def field_name(name):
+    """ Returns the bare name of a DNA field, "*next" -> "next",
+        "mat[4][4]" -> "mat", "(*func)()" -> "func" """
+    return name.lstrip("(*").split(")")[0].split("[")[0]
+
+
+def array_length(name):
+    length = 1
+    for dimension in name.split("[")[1:]:
+        length *= int(dimension.split("]")[0])
+    return length
+
+
+def parse_header(header, path):
+    """ Parses the file header, returns its size, the pointer size, the
+        file format version, the struct.pack endianness and the Blender
+        version """
+    if not header.startswith(b"BLENDER"):
+        raise BlendFileError(f"{path} is not a blend file")
+    if header[7:9].isdigit():
+        # Blender 5.0+: "BLENDER17-01v0500", header size, pointer
+        # size, file format version, endianness and version
+        header_size = int(header[7:9])
+        if header[9:10] != b"-" or header_size != 17:
+            raise BlendFileError("Unsupported blend file header")
+        return (header_size, 8, int(header[10:12]),
+                "<" if header[12:13] == b"v" else ">", int(header[13:17]))
+    # "BLENDER_v279": pointer size, endianness and version
+    return (12, 4 if header[7:8] == b"_" else 8, 0,
+            "<" if header[8:9] == b"v" else ">", int(header[9:12]))
+
+
+def block_layout(pointer_size, format_version, endian):
+    """ Returns the struct of a block header and the order of its code,
+        length, old pointer, sdna index and count in it """
+    pointer = "I" if pointer_size == 4 else "Q"
+    if format_version >= 1:
+        # code, sdna index, old pointer, 64 bit length and count
+        return struct.Struct(f"{endian}4siQqq"), (0, 3, 2, 1, 4)
+    # code, length, old pointer, sdna index and count
+    return struct.Struct(f"{endian}4si{pointer}ii"), (0, 1, 2, 3, 4)
+
+
+def parse_sdna(data, endian, pointer_size):
+    """ Parses the data of the DNA1 block, returns its Structs """
+    position = 8  # "SDNA" "NAME"
+
+    def read_int(fmt):
+        nonlocal position
+        value = struct.unpack_from(endian + fmt, data, position)[0]
+        position += struct.calcsize(fmt)
+        return value
+
+    def read_strings(count):
+        nonlocal position
+        strings = []
+        for _ in range(count):
+            end = data.index(b"\0", position)
+            strings.append(data[position:end].decode("ascii"))
+            position = end + 1
+        return strings
+
+    def align():
+        nonlocal position
+        position = (position + 3) & ~3
+
+    names = read_strings(read_int("i"))
+    align()
+    position += 4  # "TYPE"
+    types = read_strings(read_int("i"))
+    align()
+    position += 4  # "TLEN"
+    lengths = [read_int("h") for _ in types]
+    align()
+    position += 4  # "STRC"
+    structs = []
+    for _ in range(read_int("i")):
+        struct_type = read_int("h")
+        fields = dict()
+        offset = 0
+        for _ in range(read_int("h")):
+            field_type = read_int("h")
+            name = names[read_int("h")]
+            is_pointer = name.startswith("*") or name.startswith("(*")
+            count = array_length(name)
+            size = (pointer_size if is_pointer
+                    else lengths[field_type]) * count
+            fields[field_name(name)] = Field(
+                types[field_type], name, offset, size, is_pointer, count)
+            offset += size
+        dna_struct = Struct(types[struct_type], lengths[struct_type],
+                            fields)
+        structs.append(dna_struct)
+    return structs
+
+
+def group_datablocks(blocks):
+    """ Yields the first block, the size and the end offset of every ID
+        block together with the data blocks following it """
+    current = None
+    size = 0
+    end = 0
+    for block in blocks:
+        if block.code[2:] == b"\0\0":
+            if current:
+                yield current, size, end
+            current = block
+            size = block.size
+        elif current and block.code == b"DATA":
+            size += block.size
+        elif current:
+            # render info, user preferences, SDNA, ...
+            yield current, size, end
+            current = None
+        end = block.offset + block.size
+    if current:
+        yield current, size, end
+
+
+def uncompressed_size(path):
+    """ Returns the size of the file at path once decompressed, without
+        decompressing it: from the gzip trailer or the zstd seek table
+
+        gzip only stores the size modulo 4 GiB, it is taken as the
+        smallest size not below the compressed size. Returns None if
+        the size can't be told. """
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            magic = f.read(4)
+            if magic.startswith(GZIP_MAGIC):
+                f.seek(-4, os.SEEK_END)
+                uncompressed = struct.unpack("<I", f.read(4))[0]
+                while uncompressed < size:
+                    uncompressed += 1 << 32
+                return uncompressed
+            if magic == ZSTD_MAGIC:
+                return _zstd_content_size(f, size)
+            return size
+    except (OSError, struct.error):
+        return None
+
+
+def _zstd_content_size(f, size):
+    footer_size = ZSTD_SEEK_TABLE_FOOTER.size
+    if size < footer_size:
+        return None
+    f.seek(-footer_size, os.SEEK_END)
+    count, descriptor, magic = ZSTD_SEEK_TABLE_FOOTER.unpack(
+        f.read(footer_size))
+    if magic != ZSTD_SEEKABLE_MAGIC:
+        return None
+    # compressed and decompressed size, and a checksum if flagged
+    entry_size = 12 if descriptor & 0x80 else 8
+    if count * entry_size + footer_size > size:
+        return None
+    f.seek(-footer_size - count * entry_size, os.SEEK_END)
+    table = f.read(count * entry_size)
+    return sum(struct.unpack_from("<I", table, i * entry_size + 4)[0]
+               for i in range(count))
+
+
+class _StreamReader():
+    """ Reads decompressed data from an iterator of (data, compressed
+        offset) chunks, marks maps decompressed to compressed offsets at
+        the end of every chunk """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b""
+        self._index = 0
+        self.position = 0
+        self.marks = [(0, 0)]
+
+    def _fill(self):
+        for data, compressed in self._chunks:
+            self.marks.append((self.marks[-1][0] + len(data), compressed))
+            if data:
+                self._buffer = self._buffer[self._index:] + data
+                self._index = 0
+                return
+        raise BlendFileError("Blend file ends unexpectedly")
+
+    def read(self, size):
+        while len(self._buffer) - self._index < size:
+            self._fill()
+        data = self._buffer[self._index:self._index + size]
+        self._index += size
+        self.position += size
+        return data
+
+    def skip(self, size):
+        self.position += size
+        while len(self._buffer) - self._index < size:
+            size -= len(self._buffer) - self._index
+            self._buffer = b""
+            self._index = 0
+            self._fill()
+        self._index += size
+
+    def compressed_offset(self, offset):
+        """ Returns the compressed offset of a decompressed offset that
+            was read, interpolated within its chunk """
+        i = bisect.bisect_left(self.marks, (offset,))
+        if i == 0:
+            return 0
+        i = min(i, len(self.marks) - 1)
+        (start, compressed_start), (end, compressed_end) = \
+            self.marks[i - 1], self.marks[i]
+        if end == start:
+            return compressed_end
+        return compressed_start + (compressed_end - compressed_start) * \
+            (min(offset, end) - start) // (end - start)
+
+
+def _decompressor(magic):
+    if magic.startswith(GZIP_MAGIC):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if zstd is not None:
+        return zstd.ZstdDecompressor()
+    if zstandard is None:
+        raise BlendFileError("Reading zstd compressed files needs "
+                             "Python 3.14 or the zstandard module")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _decompressed_chunks(f, magic):
+    # gzip members and zstd frames are decompressed one after another
+    decompressor = _decompressor(magic)
+    offset = 0
+    while True:
+        data = f.read(STREAM_BLOCK_SIZE)
+        if not data:
+            return
+        offset += len(data)
+        chunk = decompressor.decompress(data)
+        while decompressor.eof and decompressor.unused_data:
+            rest = decompressor.unused_data
+            decompressor = _decompressor(magic)
+            chunk += decompressor.decompress(rest)
+        yield chunk, offset
+
+
+def stream_datablocks(path):
+    """ Reads the ID blocks of a gzip or zstd compressed blend file in one
+        pass, decompressing it in memory only
+
+        Returns a list of (Datablock, compressed_size) tuples, offsets are
+        in the decompressed file and compressed_size is the part of the
+        compressed file the datablock took, interpolated at block
+        boundaries.
+
+        Raises:
+        BlendFileError if the file can't be read """
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(4)
+            f.seek(0)
+            reader = _StreamReader(_decompressed_chunks(f, magic))
+            header = reader.read(12)
+            if header[7:9].isdigit():
+                header += reader.read(5)
+            _, pointer_size, format_version, endian, _ = parse_header(
+                header, path)
+            layout, order = block_layout(pointer_size, format_version,
+                                         endian)
+            blocks = []
+            prefixes = dict()
+            sdna = None
+            while True:
+                values = layout.unpack(reader.read(layout.size))
+                code, size, old, sdna_index, count = (values[i] for i in order)
+                if code == b"ENDB":
+                    break
+                block = BlockHeader(code, size, old, sdna_index, count,
+                                    reader.position)
+                blocks.append(block)
+                if code == b"DNA1":
+                    sdna = reader.read(size)
+                elif code[2:] == b"\0\0":
+                    prefixes[block.offset] = reader.read(
+                        min(size, ID_PREFIX_SIZE))
+                    reader.skip(size - len(prefixes[block.offset]))
+                else:
+                    reader.skip(size)
+    except OSError as e:
+        raise BlendFileError(f"Could not read {path}: {e}")
+    except (EOFError, ValueError, struct.error,
+            *DECOMPRESSION_ERRORS) as e:
+        raise BlendFileError(f"Invalid blend file {path}: {e}")
+    if sdna is None:
+        raise BlendFileError(f"{path} has no SDNA")
+    try:
+        field = {s.name: s for s in parse_sdna(sdna, endian, pointer_size)
+                 }["ID"].fields["name"]
+    except (KeyError, ValueError, IndexError, struct.error) as e:
+        raise BlendFileError(f"Invalid blend file {path}: {e}")
+    datablocks = []
+    for block, size, end in group_datablocks(blocks):
+        raw = prefixes[block.offset][field.offset:field.offset + field.size]
+        name = raw.split(b"\0", 1)[0].decode("utf-8", "replace")
+        # headers are part of the range, size only counts the data
+        compressed = reader.compressed_offset(end) - \
+            reader.compressed_offset(block.offset - layout.size)
+        datablocks.append((Datablock(block.code[:2].decode("ascii"),
+                                     name[2:], block, size, end),
+                           compressed))
+    return datablocks
+
+
+class BlendFile():
+    """ Memory maps an uncompressed .blend file and reads its block
+        headers and SDNA, see stream_datablocks for compressed files
+
+        Block data is only read on demand, so walking the file costs
+        little more than reading its block headers. """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self._file = open(path, "rb")
+        except OSError as e:
+            raise BlendFileError(f"Could not read {path}: {e}")
+        try:
+            magic = self._file.read(4)
+            if magic.startswith(GZIP_MAGIC) or magic == ZSTD_MAGIC:
+                raise BlendFileError(f"{path} is compressed")
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except BlendFileError:
+            self._file.close()
+            raise
+        except (OSError, ValueError) as e:
+            self._file.close()
+            raise BlendFileError(f"Could not read {path}: {e}")
+        try:
+            self._read_header()
+            self._read_blocks()
+            self._read_sdna()
+        except BlendFileError:
+            self.close()
+            raise
+        except (struct.error, ValueError, IndexError) as e:
+            self.close()
+            raise BlendFileError(f"Invalid blend file {path}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _read_header(self):
+        (self._header_size, self.pointer_size, self.format_version,
+         self.endian, self.version) = parse_header(self._map[:17],
+                                                   self.path)
+
+    def _read_blocks(self):
+        layout, order = block_layout(self.pointer_size,
+                                     self.format_version, self.endian)
+        self.blocks = []
+        offset = self._header_size
+        end = len(self._map)
+        while offset + layout.size <= end:
+            values = layout.unpack_from(self._map, offset)
+            code, size, old, sdna_index, count = (values[i] for i in order)
+            offset += layout.size
+            if code == b"ENDB":
+                break
+            self.blocks.append(BlockHeader(code, size, old, sdna_index,
+                                           count, offset))
+            offset += size
+
+    def _read_sdna(self):
+        block = next((b for b in self.blocks if b.code == b"DNA1"), None)
+        if block is None:
+            raise BlendFileError(f"{self.path} has no SDNA")
+        self.structs = parse_sdna(
+            self._map[block.offset:block.offset + block.size],
+            self.endian, self.pointer_size)
+        self.struct_by_name = {s.name: s for s in self.structs}
+
+    def read(self, block, name, struct_name=None):
+        """ Returns the value of the field name of the struct stored in
+            block, char arrays are returned as str, other fields as int
+            (or a tuple of ints for arrays)
+
+            Raises:
+            KeyError if the struct has no such field """
+        dna_struct = self.struct_by_name[struct_name] if struct_name \
+            else self.structs[block.sdna_index]
+        field = dna_struct.fields[name]
+        offset = block.offset + field.offset
+        if field.type == "char" and not field.is_pointer:
+            raw = self._map[offset:offset + field.size]
+            return raw.split(b"\0", 1)[0].decode("utf-8", "replace")
+        if field.is_pointer:
+            fmt = "I" if self.pointer_size == 4 else "Q"
+        else:
+            fmt = {1: "b", 2: "h", 4: "i", 8: "q"}[field.size // field.count]
+            if field.type in {"float", "double"}:
+                fmt = "f" if fmt == "i" else "d"
+        values = struct.unpack_from(f"{self.endian}{field.count}{fmt}",
+                                    self._map, offset)
+        return values[0] if field.count == 1 else values
+
+    def datablocks(self):
+        """ Yields a Datablock for every ID block, its size includes the
+            data blocks following it, which end at the file offset end """
+        for block, size, end in group_datablocks(self.blocks):
+            yield self._datablock(block, size, end)
+
+    def _datablock(self, block, size, end):
+        name = self.read(block, "name", "ID")
+        return Datablock(block.code[:2].decode("ascii"), name[2:], block,
+                         size, end)
+
+    def view(self, start, end):
+        """ Returns a memoryview of the file between two offsets """
+        return memoryview(self._map)[start:end]
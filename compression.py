@@ -0,0 +1,140 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import os
+import queue
+import threading
+import time
+import zlib
+
+
+# Blender writes compressed files with gzip level 1 and every version
+# since 2.80 can read them
+GZIP_LEVEL = 1
+
+# Size of the blocks read from the uncompressed file
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Number of compressed blocks buffered between the compressor and the upload
+QUEUE_SIZE = 8
+
+
+class CompressionPipeline():
+    """ Compresses a file with gzip in a worker thread while it is read
+
+        Iterating over the pipeline yields the compressed blocks. The
+        worker thread reads and compresses ahead of the consumer but
+        blocks once QUEUE_SIZE blocks are waiting, so compression and
+        upload overlap without buffering the whole file.
+
+        After the pipeline has been consumed, stats holds the time spent
+        in every stage (in seconds) and the number of bytes read and
+        produced, and digest the SHA-256 hex digest of the uncompressed
+        file. """
+
+    def __init__(self, path, level=GZIP_LEVEL, block_size=READ_BLOCK_SIZE,
+                 queue_size=QUEUE_SIZE):
+        self.path = path
+        self.level = level
+        self.block_size = block_size
+        self.size = os.path.getsize(path)
+        self.bytes_read = 0
+        self.digest = None
+        self.stats = {
+            "read": 0.0,
+            "compress": 0.0,
+            # compressor waiting for the consumer (upload is the bottleneck)
+            "producer_wait": 0.0,
+            # consumer waiting for the compressor (cpu is the bottleneck)
+            "consumer_wait": 0.0,
+            "total": 0.0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+        }
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = threading.Event()
+        self._thread = None
+
+    def __iter__(self):
+        start = time.perf_counter()
+        self._thread = threading.Thread(target=self._compress, daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                item = self._queue.get()
+                self.stats["consumer_wait"] += time.perf_counter() - wait_start
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                self.stats["bytes_out"] += len(item)
+                yield item
+        finally:
+            self.close()
+            self.stats["total"] = time.perf_counter() - start
+
+    def close(self):
+        """ Stops the worker thread, also if the pipeline wasn't consumed """
+        self._closed.set()
+        if self._thread is not None and self._thread.is_alive():
+            # unblock a waiting put()
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join()
+
+    def _put(self, item):
+        wait_start = time.perf_counter()
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.stats["producer_wait"] += time.perf_counter() - wait_start
+        return not self._closed.is_set()
+
+    def _compress(self):
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        hasher = hashlib.sha256()
+        try:
+            with open(self.path, "rb") as f:
+                while True:
+                    t = time.perf_counter()
+                    data = f.read(self.block_size)
+                    self.stats["read"] += time.perf_counter() - t
+                    if not data:
+                        break
+                    self.bytes_read += len(data)
+                    self.stats["bytes_in"] += len(data)
+                    t = time.perf_counter()
+                    hasher.update(data)
+                    block = compressor.compress(data)
+                    self.stats["compress"] += time.perf_counter() - t
+                    if block and not self._put(block):
+                        return
+            t = time.perf_counter()
+            block = compressor.flush()
+            self.stats["compress"] += time.perf_counter() - t
+            self.digest = hasher.hexdigest()
+            if not self._put(block):
+                return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
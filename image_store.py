@@ -0,0 +1,114 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# This module is also imported by prepare_scene.py inside a separate
+# Blender process, so it must only use the standard library.
+
+
+import hashlib
+import json
+import os
+
+
+class ImageStore():
+    """ Content addressed store of image files read for packing
+
+        Every payload is stored once, named by its SHA-256 digest. An
+        index maps source paths to the size and modification time they
+        had when they were read, so unchanged files are loaded from the
+        store instead of their (possibly remote) source. Once the store
+        grows beyond max_bytes, the least recently used payloads are
+        removed. """
+
+    INDEX_NAME = "index.json"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, self.INDEX_NAME)
+        try:
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = dict()
+
+    def digest(self, path):
+        """ Returns the SHA-256 hex digest of the file at path if it
+            didn't change since it was last read, otherwise None """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self.index.get(path)
+        if entry and entry["size"] == st.st_size and \
+                entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["hash"]
+        return None
+
+    def read(self, path):
+        """ Returns the content of the file at path and True if it came
+            from the store, False if the file had to be read """
+        st = os.stat(path)
+        entry = self.index.get(path)
+        if entry and entry["size"] == st.st_size and \
+                entry["mtime_ns"] == st.st_mtime_ns:
+            payload = os.path.join(self.directory, entry["hash"])
+            try:
+                with open(payload, "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None and len(data) == st.st_size:
+                # mark as recently used
+                os.utime(payload)
+                return data, True
+
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        payload = os.path.join(self.directory, digest)
+        if not os.path.exists(payload):
+            tmp_payload = f"{payload}.tmp"
+            with open(tmp_payload, "wb") as f:
+                f.write(data)
+            os.replace(tmp_payload, payload)
+        self.index[path] = {"size": st.st_size,
+                            "mtime_ns": st.st_mtime_ns,
+                            "hash": digest}
+        return data, False
+
+    def save(self):
+        """ Writes the index and removes the least recently used
+            payloads beyond max_bytes """
+        payloads = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name == self.INDEX_NAME or name.endswith(".tmp"):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            payloads.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        payloads.sort()
+        removed = set()
+        while payloads and total > self.max_bytes:
+            mtime, size, name = payloads.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            removed.add(name)
+            total -= size
+        self.index = {path: entry for path, entry in self.index.items()
+                      if entry["hash"] not in removed}
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
@@ -16,9 +16,357 @@ import bpy
 import os
 import json
 import threading
-from . import sheepit
 import time
+import tempfile
+import concurrent.futures
+from . import sheepit
+from . import worker_pool
+from . import prepare_cache
+from . import blendfile
+from . import scratch
+from . import preflight
+from . import archive
+import shutil
 import subprocess
+import sys
+from bpy.app.handlers import persistent
+from bpy_extras.io_utils import ExportHelper
+from . import size_report
+
+
+# Blender workers kept running between submissions, see worker_pool
+prepare_worker_pool = None
+
+# Size report of the last uploaded file, see size_report
+last_size_report = None
+
+# Whether the server continued a resumed upload, kept between
+# submissions, see sheepit.Sheepit.upload_file
+upload_accepts_ranges = None
+
+# Number of datablocks listed in the panel
+SIZE_REPORT_TOP = 10
+
+# Assumed ratio of uncompressed to compressed size of blend files whose
+# uncompressed size isn't stored in the file
+COMPRESSION_RATIO_ESTIMATE = 4
+
+PREPARE_SCRIPT = os.path.join(os.path.dirname(__file__), "prepare_scene.py")
+
+# Niceness of the Blender preparing the saved file in the background
+BACKGROUND_NICENESS = 10
+
+# Seconds between checks of the background preparation
+BACKGROUND_POLL_INTERVAL = 1.0
+
+# Preparation of the saved file running in the background, see
+# background_prepare_timer()
+background_prepare = None
+
+# time.monotonic() of the last save of the open file
+last_save_time = 0.0
+
+
+def scratch_directory(preferences):
+    """ Returns the directory holding the work directories of
+        submissions """
+    if preferences.scratch_dir:
+        return bpy.path.abspath(preferences.scratch_dir)
+    temp = bpy.context.preferences.filepaths.temporary_directory
+    return os.path.join(temp or tempfile.gettempdir(), "sheepit")
+
+
+def estimate_required_space(copy_source):
+    """ Returns the number of bytes preparing the open scene needs in the
+        scratch directory: the copy of the saved file if copy_source, and
+        the prepared file holding it together with all images that get
+        packed """
+    source_size = 0
+    if bpy.data.filepath:
+        # compressed files are written uncompressed first, the size is
+        # read from the compressed file without decompressing it
+        source_size = blendfile.uncompressed_size(bpy.data.filepath)
+        if source_size is None and os.path.isfile(bpy.data.filepath):
+            source_size = int(os.path.getsize(bpy.data.filepath)
+                              * COMPRESSION_RATIO_ESTIMATE)
+        source_size = source_size or 0
+    images_size = 0
+    for image in bpy.data.images:
+        if image.packed_file or image.source != 'FILE':
+            continue
+        path = bpy.path.abspath(image.filepath, library=image.library)
+        if os.path.isfile(path):
+            images_size += os.path.getsize(path)
+    required = source_size + images_size
+    if copy_source:
+        required += source_size
+    return required
+
+
+def prepare_script_args(preferences):
+    """ Returns the prepare_scene.py options set in the preferences,
+        options that depend on the submission are added by the caller """
+    args = []
+    if preferences.compress_while_uploading and \
+            not preferences.submit_as_archive:
+        args.append("--uncompressed")
+    if preferences.use_image_store:
+        args += [
+            "--image-store", cache_directory(preferences, "images"),
+            "--image-store-size",
+            str(int(preferences.image_store_size * 1024**3))]
+    if preferences.use_texture_transcoding:
+        args += [
+            "--transcode-dir", cache_directory(preferences, "transcoded"),
+            "--max-texture-size", str(preferences.max_texture_size)]
+        for rule in preferences.texture_rules.split(","):
+            if rule.strip():
+                args += ["--texture-rule", rule.strip()]
+    return args
+
+
+def prepared_scene_cache(preferences):
+    return prepare_cache.PreparedSceneCache(
+        cache_directory(preferences, "scenes"),
+        int(preferences.prepared_cache_size * 1024**3))
+
+
+def prepared_cache_key(cache, script_args):
+    """ Returns the cache key of the saved file prepared with
+        script_args, only valid while the open file isn't dirty """
+    return cache.key(bpy.data.filepath,
+                     bpy.utils.blend_paths(absolute=True),
+                     options=(bpy.app.version_string,
+                              *script_args,
+                              sheepit.file_fingerprint(PREPARE_SCRIPT)))
+
+
+def cache_directory(preferences, name):
+    """ Returns the directory of the cache name ("scenes" or "images") """
+    if preferences.cache_dir:
+        root = bpy.path.abspath(preferences.cache_dir)
+    else:
+        root = bpy.utils.user_resource('DATAFILES', path="sheepit_cache",
+                                       create=True)
+    return os.path.join(root, name)
+
+
+def run_preflight(context):
+    """ Analyses the scene and stores the issues for the panel,
+        returns them """
+    preferences = context.preferences.addons[__package__].preferences
+    start = time.perf_counter()
+    issues = preflight.analyse(context.scene,
+                               archive=preferences.submit_as_archive)
+    if 'sheepit' not in context.window_manager:
+        context.window_manager['sheepit'] = dict()
+    context.window_manager['sheepit']['preflight'] = json.dumps(issues)
+    print(f"SheepIt! checked scene in {time.perf_counter() - start:.3f}s")
+    return issues
+
+
+def low_priority_command(command):
+    """ Returns command and the Popen keyword arguments that run it at
+        low CPU and IO priority """
+    if sys.platform == "win32":
+        return command, {"creationflags": subprocess.IDLE_PRIORITY_CLASS}
+    prefix = []
+    ionice = shutil.which("ionice")
+    if ionice:
+        # idle IO class, only reads from disk when nothing else does
+        prefix += [ionice, "-c", "3"]
+    nice = shutil.which("nice")
+    if nice:
+        prefix += [nice, "-n", str(BACKGROUND_NICENESS)]
+    return prefix + command, dict()
+
+
+class BackgroundPrepare():
+    """ Prepares the saved file into the prepared scene cache in a low
+        priority Blender process
+
+        The cache key is taken when the preparation starts and checked
+        again before the prepared file is stored, so a file that changed
+        in the meantime is never cached under the old key. The prepared
+        file is moved into the cache by a thread, Blender is stopped if
+        it runs longer than the preparation timeout. """
+
+    def __init__(self, preferences):
+        self.script_args = prepare_script_args(preferences)
+        self.cache = prepared_scene_cache(preferences)
+        self.key = prepared_cache_key(self.cache, self.script_args)
+        self.source_path = bpy.data.filepath
+        self.blend_name = os.path.basename(self.source_path)
+        self.scratch_root = scratch_directory(preferences)
+        self.timeout = preferences.prepare_timeout * 60
+        self.process = None
+        self.work_dir = None
+        self.store_thread = None
+
+    def start(self):
+        """ Starts Blender, returns False if there is nothing to do """
+        if self.cache.lookup(self.key, self.blend_name):
+            return False
+        error = scratch.check_free_space(self.scratch_root,
+                                         estimate_required_space(False))
+        if error:
+            print(f"SheepIt! not preparing in the background: {error}")
+            return False
+        self.work_dir = scratch.WorkDirectory(self.scratch_root)
+        self.filepath = self.work_dir.file(self.blend_name)
+        command, options = low_priority_command([
+            bpy.app.binary_path,
+            self.source_path,
+            "--background",
+            "--factory-startup",
+            "--python",
+            PREPARE_SCRIPT,
+            "--",
+            "--output",
+            self.filepath,
+            *self.script_args
+        ])
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                                        shell=False, **options)
+        self.start_time = time.monotonic()
+        return True
+
+    def poll(self):
+        """ Returns True while Blender is running or the prepared file is
+            stored, starts storing it once Blender finished """
+        if self.store_thread:
+            return self.store_thread.is_alive()
+        if self.process.poll() is None:
+            if self.timeout and \
+                    time.monotonic() - self.start_time > self.timeout:
+                print("SheepIt! preparing the scene in the background "
+                      "timed out")
+                self.cancel()
+                return False
+            return True
+        try:
+            with open(f"{self.filepath}.result.json", "r") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            result = {"error": "Error opening result"}
+        if result["error"]:
+            print("SheepIt! could not prepare the scene in the background: "
+                  + result["error"])
+        elif bpy.data.filepath != self.source_path or \
+                prepared_cache_key(self.cache, self.script_args) != self.key:
+            print("SheepIt! the scene changed while it was prepared in the "
+                  "background")
+        else:
+            # copying into a cache on another drive takes a while
+            self.store_thread = threading.Thread(
+                target=self.store, args=(result,), daemon=True)
+            self.store_thread.start()
+            return True
+        self.work_dir.cleanup()
+        return False
+
+    def store(self, result):
+        try:
+            self.cache.store(self.key, self.blend_name, self.filepath,
+                             move=True)
+            print(f"SheepIt! prepared {self.blend_name} in the "
+                  f"background in {result['steps']['total']:.2f}s")
+        except OSError as e:
+            print(f"SheepIt! could not cache the prepared scene: {e}")
+        finally:
+            self.work_dir.cleanup()
+
+    def cancel(self):
+        if self.store_thread:
+            # storing doesn't read the saved file, it cleans up itself
+            return
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.work_dir:
+            self.work_dir.cleanup()
+
+
+def cancel_background_prepare():
+    global background_prepare
+    if background_prepare:
+        background_prepare.cancel()
+        background_prepare = None
+
+
+def background_prepare_timer():
+    """ Starts preparing the saved file once it wasn't saved or changed
+        for the idle time set in the preferences, then waits for Blender
+        to finish. Returns the seconds until it is called again, or None
+        to stop. """
+    global background_prepare
+    if background_prepare:
+        if background_prepare.poll():
+            return BACKGROUND_POLL_INTERVAL
+        background_prepare = None
+        return None
+    preferences = bpy.context.preferences.addons[__package__].preferences
+    if not preferences.use_background_prepare or \
+            not preferences.use_prepared_cache or \
+            preferences.submit_as_archive or not bpy.data.filepath:
+        return None
+    # the file changed since it was saved, the next save starts the
+    # timer again
+    if bpy.data.is_dirty:
+        return None
+    idle = time.monotonic() - last_save_time
+    if idle < preferences.background_prepare_delay:
+        return preferences.background_prepare_delay - idle
+    wm = bpy.context.window_manager
+    if 'sheepit' in wm and wm['sheepit'].get('upload_active'):
+        # the submission prepares the scene itself
+        return None
+    prepare = None
+    try:
+        prepare = BackgroundPrepare(preferences)
+        if not prepare.start():
+            return None
+    except OSError as e:
+        if prepare:
+            prepare.cancel()
+        print(f"SheepIt! could not prepare the scene in the background: {e}")
+        return None
+    background_prepare = prepare
+    return BACKGROUND_POLL_INTERVAL
+
+
+@persistent
+def on_save_pre(*args):
+    # the file Blender is reading is about to be replaced
+    cancel_background_prepare()
+
+
+@persistent
+def on_save_post(*args):
+    global last_save_time
+    preferences = bpy.context.preferences.addons[__package__].preferences
+    if not preferences.use_background_prepare:
+        return
+    last_save_time = time.monotonic()
+    if not bpy.app.timers.is_registered(background_prepare_timer):
+        bpy.app.timers.register(
+            background_prepare_timer,
+            first_interval=preferences.background_prepare_delay)
+
+
+@persistent
+def on_load_pre(*args):
+    cancel_background_prepare()
+    if bpy.app.timers.is_registered(background_prepare_timer):
+        bpy.app.timers.unregister(background_prepare_timer)
+
+
+def get_prepare_worker_pool(blender_exe, prepare_script):
+    global prepare_worker_pool
+    if prepare_worker_pool is None:
+        prepare_worker_pool = worker_pool.PrepareWorkerPool(
+            blender_exe, prepare_script)
+    return prepare_worker_pool
 
 
 def register():
@@ -27,6 +375,11 @@ def register():
     bpy.utils.register_class(SHEEPIT_OT_logout)
     bpy.utils.register_class(SHEEPIT_OT_create_accout)
     bpy.utils.register_class(SHEEPIT_OT_refresh_profile)
+    bpy.utils.register_class(SHEEPIT_OT_check_scene)
+    bpy.utils.register_class(SHEEPIT_OT_export_size_report)
+    bpy.app.handlers.save_pre.append(on_save_pre)
+    bpy.app.handlers.save_post.append(on_save_post)
+    bpy.app.handlers.load_pre.append(on_load_pre)
 
 
 def unregister():
@@ -35,6 +388,16 @@ def unregister():
     bpy.utils.unregister_class(SHEEPIT_OT_logout)
     bpy.utils.unregister_class(SHEEPIT_OT_create_accout)
     bpy.utils.unregister_class(SHEEPIT_OT_refresh_profile)
+    bpy.utils.unregister_class(SHEEPIT_OT_check_scene)
+    bpy.utils.unregister_class(SHEEPIT_OT_export_size_report)
+    bpy.app.handlers.save_pre.remove(on_save_pre)
+    bpy.app.handlers.save_post.remove(on_save_post)
+    bpy.app.handlers.load_pre.remove(on_load_pre)
+    on_load_pre()
+    global prepare_worker_pool
+    if prepare_worker_pool is not None:
+        prepare_worker_pool.shutdown()
+        prepare_worker_pool = None
 
 
 class SHEEPIT_OT_send_project(bpy.types.Operator):
@@ -91,14 +454,58 @@ class SHEEPIT_OT_send_project(bpy.types.Operator):
                 return {'CANCELLED'}
 
             bpy.context.window_manager['sheepit']['upload_status'] = "Project uploaded!"
+            if self.size_report:
+                global last_size_report
+                last_size_report = self.size_report
+                bpy.context.window_manager['sheepit']['size_categories'] = \
+                    json.dumps(size_report.category_totals(self.size_report))
+                bpy.context.window_manager['sheepit']['size_top'] = \
+                    json.dumps(self.size_report[:SIZE_REPORT_TOP])
+            if self.duplicate_of:
+                uploaded = time.strftime(
+                    "%Y-%m-%d %H:%M",
+                    time.localtime(self.duplicate_of["uploaded"]))
+                self.report({'INFO'}, "An identical project was already "
+                            f"uploaded on {uploaded}")
             self.cancel(context)
             return {'FINISHED'}
         return {'PASS_THROUGH'}
 
     def execute(self, context):
+        # don't upload projects the farm will reject
+        issues = run_preflight(context)
+        for issue in issues:
+            if issue["severity"] == preflight.WARNING:
+                self.report({'WARNING'}, issue["message"])
+        blockers = [i for i in issues if i["severity"] == preflight.BLOCKER]
+        if blockers:
+            for issue in blockers:
+                self.report({'ERROR'}, issue["message"])
+            return {'CANCELLED'}
+
+        # a preparation running in the background would compete with
+        # the one of this submission
+        cancel_background_prepare()
+
         # prepare cookies
         preferences = context.preferences.addons[__package__].preferences
         self.cookies = json.loads(preferences.cookies)
+        self.submit_as_archive = preferences.submit_as_archive
+        self.archive_compression_level = \
+            preferences.archive_compression_level
+        self.archive_compression_threads = \
+            preferences.archive_compression_threads or os.cpu_count() or 1
+        self.archive_chunked_upload = preferences.archive_chunked_upload
+        self.resumable_upload = preferences.resumable_upload
+        self.use_size_report = preferences.use_size_report
+        # archives are sent as they are, so the blend file inside them
+        # is compressed by Blender
+        self.compress_while_uploading = \
+            preferences.compress_while_uploading and \
+            not self.submit_as_archive
+        self.use_prepare_worker = preferences.use_prepare_worker
+        self.prepare_timeout = preferences.prepare_timeout * 60
+        self.script_args = prepare_script_args(preferences)
 
         # prepare variables
         self.animation = context.scene.sheepit_properties.type == 'animation'
@@ -129,18 +536,80 @@ class SHEEPIT_OT_send_project(bpy.types.Operator):
         else:
             self.split_layers = context.scene.sheepit_properties.still_layer_split
 
-        # Save file
+        # Prepare script variables
+        self.blender_exe = bpy.app.binary_path
+        self.prepare_script = PREPARE_SCRIPT
+
         blend_name = os.path.split(bpy.data.filepath)[1]
         if not blend_name:
             blend_name = "untitled.blend"
-        self.filepath = os.path.join(bpy.app.tempdir, blend_name)
-        bpy.ops.wm.save_as_mainfile(filepath=self.filepath, copy=True)
-
-        # Prepare script variables
-        self.blender_exe = bpy.app.binary_path
-        self.prepare_script = os.path.join(os.path.dirname(__file__),
-                                           "prepare_scene.py"
-                                           )
+        self.blend_name = blend_name
+        # all intermediate files of this submission are kept in a work
+        # directory that is removed as a whole, work directories of
+        # crashed sessions are removed here too
+        scratch_root = scratch_directory(preferences)
+        scratch.remove_stale_work_directories(scratch_root)
+        try:
+            self.work_dir = scratch.WorkDirectory(scratch_root)
+        except OSError as e:
+            self.report({'ERROR'}, f"Can't use scratch directory: {e}")
+            return {'CANCELLED'}
+        self.filepath = self.work_dir.file(blend_name)
+        if self.submit_as_archive:
+            self.script_args += [
+                "--archive-root",
+                os.path.dirname(bpy.data.filepath) or self.work_dir.path]
+
+        # Look for an already prepared version of this file, the saved
+        # file can only be used as key if it matches the open scene
+        self.prepared_cache = None
+        self.cache_key = None
+        self.cached_file = None
+        # the cache only holds the blend file, not the files next to it
+        # in an archive
+        if preferences.use_prepared_cache and bpy.data.filepath and \
+                not bpy.data.is_dirty and not self.submit_as_archive:
+            self.prepared_cache = prepared_scene_cache(preferences)
+            self.cache_key = prepared_cache_key(self.prepared_cache,
+                                                self.script_args)
+            self.cached_file = self.prepared_cache.lookup(self.cache_key,
+                                                          blend_name)
+
+        # Save file, the scene is read from the saved file if it matches
+        # the open scene, otherwise from a copy. The prepared scene is
+        # always written to a new path, so Blender doesn't write a
+        # .blend1 backup.
+        self.source_copy = None
+        self.bytes_written = 0
+        if self.cached_file:
+            self.upload_path = self.cached_file
+        else:
+            self.upload_path = self.filepath
+            copy_source = not bpy.data.filepath or bpy.data.is_dirty
+            # fail now instead of minutes into the preparation
+            error = scratch.check_free_space(
+                self.work_dir.path, estimate_required_space(copy_source))
+            if error:
+                self.work_dir.cleanup()
+                self.report({'ERROR'}, error)
+                return {'CANCELLED'}
+            if copy_source:
+                self.source_copy = self.work_dir.file("source", blend_name)
+                self.source_path = self.source_copy
+                try:
+                    bpy.ops.wm.save_as_mainfile(filepath=self.source_copy,
+                                                copy=True)
+                except RuntimeError as e:
+                    self.work_dir.cleanup()
+                    self.report({'ERROR'}, f"Could not save scene: {e}")
+                    return {'CANCELLED'}
+                self.bytes_written += os.path.getsize(self.source_copy)
+            else:
+                self.source_path = bpy.data.filepath
+        config = bpy.utils.user_resource('CONFIG', path="sheepit",
+                                         create=True)
+        self.upload_index = os.path.join(config, "uploads.json")
+        self.prepare_history = os.path.join(config, "prepare_history.json")
 
         if 'sheepit' not in bpy.context.window_manager:
             bpy.context.window_manager['sheepit'] = dict()
@@ -153,9 +622,6 @@ class SHEEPIT_OT_send_project(bpy.types.Operator):
         self.thread = threading.Thread(target=self.send_project)
         self.thread.start()
 
-        self.upload_thread = threading.Thread(target=self.update_progress)
-        self.uploading = True
-
         wm = context.window_manager
         self._timer = wm.event_timer_add(0.1, window=context.window)
         wm.modal_handler_add(self)
@@ -165,6 +631,9 @@ class SHEEPIT_OT_send_project(bpy.types.Operator):
     def send_project(self):
         # create error variables
         self.error = ""
+        self.duplicate_of = None
+        self.size_report = None
+        self.archive_members = []
         self.error_at = ""
 
         session = sheepit.Sheepit()
@@ -179,69 +648,96 @@ class SHEEPIT_OT_send_project(bpy.types.Operator):
         
         self.progress = 5
 
-        self.status = "Preparing Scene"
-
-        # Prepare scene
-        r = subprocess.run(
-            [
-                self.blender_exe,
-                self.filepath,
-                "--background",
-                "--factory-startup",
-                "--python",
-                self.prepare_script
-            ], shell=False
-        )
-        try:
-            with open(f"{self.filepath}.log", "r") as f:
-                output = f.read().split("<->")
-
-                if len(output) == 0 or output[0] != "OK":
-                    if len(output) > 1:
-                        self.error = output[1]
-                    else:
-                        self.error = "unknown error"
-                    self.error_at = "prepare scene"
-                    return
-        except OSError:
-            self.error = "Error opening log"
-            self.error_at = "prepare scene"
-            return
-
-        self.progress = 10
-
-        self.status = "Getting Token"
+        if self.cached_file:
+            self.status = "Using cached Scene"
+            prepare = None
+        else:
+            self.status = "Preparing Scene"
+            prepare = self.start_prepare()
 
-        # request a upload token from the SheepIt server
+        # The upload token doesn't depend on the prepared scene, request
+        # it while Blender is running. This also opens the connection
+        # that is reused for the upload.
         token = ""
         try:
             token = session.request_upload_token()
-        except sheepit.NetworkException as e:
-            self.error = str(e)
-            self.error_at = "token"
-            return
-        except sheepit.UploadException as e:
+        except (sheepit.NetworkException, sheepit.UploadException) as e:
+            # no need to wait for a scene that can't be uploaded
+            if prepare:
+                self.cancel_prepare(prepare)
             self.error = str(e)
             self.error_at = "token"
             return
+
+        if prepare:
+            result = self.finish_prepare(prepare)
+            self.record_prepare(result)
+            if result["error"]:
+                self.error = result["error"]
+                self.error_at = "prepare scene"
+                return
+            self.bytes_written += result["output_size"]
+            self.archive_members = result.get("archive_members", [])
+
         self.progress = 15
 
         self.status = "Uploading File"
 
-        self.token = token
-        self.upload_thread.start()
-
         # upload the file
+        upload_size = None
         try:
-            session.upload_file(token, self.filepath)
-        except sheepit.NetworkException as e:
+            if self.submit_as_archive:
+                self.status = "Reading archive files"
+                # zlib releases the GIL, so threads compress in parallel.
+                # Processes can't be used, they would import this add-on
+                # and with it bpy.
+                with concurrent.futures.ThreadPoolExecutor(
+                        self.archive_compression_threads) as executor:
+                    project = archive.ZipStream(
+                        [(self.upload_path, self.blend_name)]
+                        + self.archive_members,
+                        level=self.archive_compression_level,
+                        executor=executor,
+                        workers=self.archive_compression_threads,
+                        measure=not self.archive_chunked_upload)
+                    project.scan()
+                    self.status = "Uploading Archive"
+                    digest = session.upload_archive(
+                        token, project,
+                        os.path.splitext(self.blend_name)[0] + ".zip",
+                        progress_callback=self.update_progress)
+                    # only known once chunked archives were sent
+                    upload_size = project.size
+            elif self.compress_while_uploading:
+                digest, stats = session.upload_file_compressed(
+                    token, self.upload_path,
+                    progress_callback=self.update_progress)
+                print("SheepIt! compression pipeline: " + ", ".join(
+                    f"{k} {v:.2f}s" if isinstance(v, float) else f"{k} {v}"
+                    for k, v in stats.items()))
+            else:
+                global upload_accepts_ranges
+                session.accepts_ranges = upload_accepts_ranges
+                try:
+                    digest = session.upload_file(
+                        token, self.upload_path,
+                        resumable=self.resumable_upload,
+                        progress_callback=self.update_progress)
+                finally:
+                    upload_accepts_ranges = session.accepts_ranges
+        except (sheepit.NetworkException, OSError) as e:
             self.error = str(e)
             self.error_at = "upload"
-            self.uploading = False
             return
-        self.uploading = False
-        if self.upload_thread.is_alive():
-            self.upload_thread.join()
+        if digest:
+            index = sheepit.UploadIndex(self.upload_index)
+            try:
+                self.duplicate_of = index.lookup(digest)
+                index.add(digest,
+                          upload_size or os.path.getsize(self.upload_path),
+                          token)
+            except OSError as e:
+                print(f"SheepIt! could not record the upload: {e}")
         self.progress = 95
 
         self.status = "Adding Project"
@@ -264,39 +760,152 @@ class SHEEPIT_OT_send_project(bpy.types.Operator):
         except sheepit.NetworkException as e:
             self.error = str(e)
             self.error_at = "add project"
+            return
+
+        # rank what the uploaded file is made of, read from the file
+        # since the scene in this Blender isn't the prepared one
+        if self.use_size_report:
+            self.status = "Analysing upload size"
+            try:
+                self.size_report = size_report.size_report(
+                    self.upload_path)
+            except blendfile.BlendFileError as e:
+                print(f"SheepIt! could not analyse the upload size: {e}")
+
+        if self.prepared_cache and not self.cached_file:
+            self.status = "Caching prepared Scene"
+            try:
+                self.prepared_cache.store(self.cache_key, self.blend_name,
+                                          self.filepath)
+                self.bytes_written += os.path.getsize(self.filepath)
+            except OSError as e:
+                print(f"SheepIt! could not cache the prepared scene: {e}")
+        print(f"SheepIt! wrote {self.bytes_written} bytes for this "
+              "submission")
         self.progress = 100
         return
 
-    def update_progress(self):
-        session = sheepit.Sheepit()
+    def start_prepare(self):
+        """ Starts preparing the scene in a Blender worker or a new
+            Blender process, returns a handle for finish_prepare() """
+        if self.use_prepare_worker:
+            pool = get_prepare_worker_pool(self.blender_exe,
+                                           self.prepare_script)
+            return pool.submit(self.source_path, self.filepath,
+                               self.script_args,
+                               progress_callback=self.prepare_progress)
+        process = subprocess.Popen(
+            [
+                self.blender_exe,
+                self.source_path,
+                "--background",
+                "--factory-startup",
+                "--python",
+                self.prepare_script,
+                "--",
+                "--output",
+                self.filepath,
+                *self.script_args
+            ], stdout=subprocess.PIPE, encoding="utf-8", errors="replace",
+            bufsize=1, shell=False
+        )
+        threading.Thread(target=self.read_prepare_output,
+                         args=(process.stdout,), daemon=True).start()
+        return process
+
+    def read_prepare_output(self, stdout):
+        """ Forwards the progress events of prepare_scene.py, the rest
+            of Blender's output is printed as before """
+        for line in stdout:
+            event = worker_pool.parse_progress(line)
+            if event:
+                self.prepare_progress(event)
+            else:
+                print(line, end="")
+
+    def prepare_progress(self, event):
+        # called from the output reader thread, the modal timer shows it
+        done = event["index"]
+        if event["total"]:
+            done += event["item"] / event["total"]
+        self.progress = int(5 + done / event["steps"] * 10)
+        step = event["step"].replace("_", " ")
+        if event["total"]:
+            self.status = (f"Preparing Scene ({step} "
+                           f"{event['item']}/{event['total']})")
+        else:
+            self.status = f"Preparing Scene ({step})"
 
-        # import cookies
-        session.import_session(self.cookies)
-        while self.uploading:
-            time.sleep(1)
+    def cancel_prepare(self, prepare):
+        if self.use_prepare_worker:
+            get_prepare_worker_pool(self.blender_exe,
+                                    self.prepare_script).cancel(prepare)
+            concurrent.futures.wait([prepare])
+        else:
+            prepare.kill()
+            prepare.wait()
+
+    def finish_prepare(self, prepare):
+        """ Waits for the scene to be prepared, returns the result dict
+            of prepare_scene.prepare(), its "error" is empty on success """
+        timeout = self.prepare_timeout or None
+        if self.use_prepare_worker:
             try:
-                p = session.get_upload_progress(self.token)
-                if p:
-                    self.progress = int(15+(p*80))
-            except Exception:
-                pass
+                return prepare.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                self.cancel_prepare(prepare)
+                return {"error": "Preparing the scene timed out"}
+            except (worker_pool.WorkerError,
+                    concurrent.futures.CancelledError) as e:
+                return {"error": str(e) or "Blender worker was stopped"}
+        try:
+            prepare.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.cancel_prepare(prepare)
+            return {"error": "Preparing the scene timed out"}
+        try:
+            with open(f"{self.filepath}.result.json", "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"error": "Error opening result"}
+
+    def record_prepare(self, result):
+        """ Adds a prepare result to the history and prints it next to
+            the previous results of this file """
+        if "steps" not in result:
+            return
+        history = prepare_cache.PrepareHistory(self.prepare_history)
+        previous = history.summary(result["file"])
+        try:
+            history.add(result)
+        except OSError as e:
+            print(f"SheepIt! could not write the prepare history: {e}")
+        print(f"SheepIt! prepared {result['file']} with Blender "
+              f"{result['blender_version']}: " + ", ".join(
+                  f"{name} {seconds:.2f}s"
+                  for name, seconds in result["steps"].items()))
+        for version, steps in previous.items():
+            print(f"SheepIt! previous mean with Blender {version}: "
+                  + ", ".join(f"{name} {seconds:.2f}s"
+                              for name, seconds in steps.items()))
+
+    def update_progress(self, bytes_sent, total_bytes, bytes_per_second):
+        # called from the upload thread, the modal timer shows it
+        if total_bytes:
+            self.progress = int(15+(bytes_sent/total_bytes*80))
+        if bytes_per_second:
+            seconds_left = (total_bytes - bytes_sent) / bytes_per_second
+            self.status = f"Uploading File ({bytes_per_second/1e6:.1f} MB/s, " \
+                f"{int(seconds_left//60)}:{int(seconds_left%60):02} left)"
 
     def cancel(self, context):
         wm = context.window_manager
         wm.event_timer_remove(self._timer)
         bpy.context.window_manager['sheepit']['upload_active'] = False
         del bpy.context.window_manager['sheepit']['progress']
-        self.uploading = False
-        if self.upload_thread.is_alive():
-            self.upload_thread.join()
         if self.thread.is_alive():
             self.thread.join()
-        try:
-            os.remove(self.filepath)
-            os.remove(f"{self.filepath}.log")
-            os.remove(f"{self.filepath}1")
-        except FileNotFoundError as e:
-            pass
+        self.work_dir.cleanup()
         context.area.tag_redraw()
 
 
@@ -411,6 +1020,51 @@ class SHEEPIT_OT_refresh_profile(bpy.types.Operator):
             self.profile = e
 
 
+class SHEEPIT_OT_check_scene(bpy.types.Operator):
+    """ Check the scene for problems before sending it """
+    bl_idname = "sheepit.check_scene"
+    bl_label = "Check Scene"
+
+    def execute(self, context):
+        issues = run_preflight(context)
+        if not issues:
+            self.report({'INFO'}, "No problems found")
+        return {'FINISHED'}
+
+
+class SHEEPIT_OT_export_size_report(bpy.types.Operator, ExportHelper):
+    """ Export the size report of the last upload as JSON or CSV """
+    bl_idname = "sheepit.export_size_report"
+    bl_label = "Export Size Report"
+
+    filename_ext = ".json"
+    filter_glob: bpy.props.StringProperty(default="*.json;*.csv",
+                                          options={'HIDDEN'})
+    format: bpy.props.EnumProperty(
+        name="Format",
+        items=[
+            ("JSON", "JSON", "Category totals and all datablocks"),
+            ("CSV", "CSV", "One row per datablock"),
+        ])
+
+    @classmethod
+    def poll(cls, context):
+        return last_size_report is not None
+
+    def check(self, context):
+        # keep the extension in line with the format
+        self.filename_ext = ".csv" if self.format == 'CSV' else ".json"
+        return super().check(context)
+
+    def execute(self, context):
+        try:
+            size_report.export(last_size_report, self.filepath)
+        except OSError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+
 class SHEEPIT_OT_login(bpy.types.Operator):
     """ Login to SheepIt! """
     bl_idname = "sheepit.login"
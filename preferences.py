@@ -25,10 +25,182 @@ def unregister():
 
 class SheepItPreferences(bpy.types.AddonPreferences):
     """ Persistant properties for this Addon
-        Currently only login information is stored here. """
+        Login information and upload settings are stored here. """
     bl_idname = __package__
 
     # cookies are stored as a serialized dict
     cookies: bpy.props.StringProperty(default="")
     username: bpy.props.StringProperty(default="")
     logged_in: bpy.props.BoolProperty(default=False)
+
+    compress_while_uploading: bpy.props.BoolProperty(
+        name="Compress while uploading",
+        default=False,
+        description="Save the prepared scene uncompressed and compress it "
+        "in a background thread while it is uploaded. This overlaps "
+        "compression and upload, but the upload can't be resumed if "
+        "the connection drops.")
+
+    resumable_upload: bpy.props.BoolProperty(
+        name="Resume dropped uploads",
+        default=False,
+        description="Retry an upload when the connection drops, "
+        "continuing where the server stopped receiving. Servers that "
+        "don't continue uploads get the whole file again.")
+
+    submit_as_archive: bpy.props.BoolProperty(
+        name="Send external files in a ZIP archive",
+        default=False,
+        description="Send caches, volumes, movie clips and image "
+        "sequences that can't be packed in a ZIP archive next to the "
+        "blend file. The archive is built while it is uploaded, without "
+        "writing it to disk.")
+
+    archive_compression_level: bpy.props.IntProperty(
+        name="Archive compression level",
+        default=1,
+        min=0,
+        max=9,
+        description="zlib level the files in the archive are compressed "
+        "with, 0 stores them. Files that don't compress, like videos and "
+        "compressed EXRs, are always stored. Files are compressed twice, "
+        "once to learn the size of the archive before it is uploaded.")
+
+    archive_chunked_upload: bpy.props.BoolProperty(
+        name="Compress archive files once",
+        default=False,
+        description="Compress the files in the archive only while it is "
+        "uploaded. The size of the archive isn't known in advance, so it "
+        "is sent with chunked transfer encoding, which the server or a "
+        "proxy in between may not accept.")
+
+    archive_compression_threads: bpy.props.IntProperty(
+        name="Archive compression threads",
+        default=0,
+        min=0,
+        max=64,
+        description="Number of threads compressing the archive, 0 uses "
+        "one per CPU")
+
+    use_prepare_worker: bpy.props.BoolProperty(
+        name="Keep Blender running for scene preparation",
+        default=False,
+        description="Prepare scenes in a Blender process that keeps "
+        "running in the background between submissions, instead of "
+        "starting a new Blender for every submission. The process is "
+        "restarted after 10 submissions or when it used too much memory.")
+
+    prepare_timeout: bpy.props.IntProperty(
+        name="Preparation Timeout (minutes)",
+        default=60,
+        min=0,
+        description="Stop Blender and cancel the submission if preparing "
+        "the scene takes longer, 0 waits forever")
+
+    use_prepared_cache: bpy.props.BoolProperty(
+        name="Cache prepared scenes",
+        default=False,
+        description="Keep prepared scenes, so submitting a saved file "
+        "again without changes to it or any of its external files "
+        "skips the preparation.")
+    use_background_prepare: bpy.props.BoolProperty(
+        name="Prepare saved scenes in the background",
+        default=False,
+        description="Prepare the saved file into the cache at low "
+        "priority once it wasn't changed for a while after saving, so "
+        "submitting it doesn't have to wait for the preparation. Saving "
+        "again cancels a running preparation.")
+    background_prepare_delay: bpy.props.IntProperty(
+        name="Idle Time (seconds)",
+        default=30,
+        min=1,
+        description="Start preparing the saved file once it wasn't "
+        "saved or changed for this long")
+    use_image_store: bpy.props.BoolProperty(
+        name="Cache packed images",
+        default=False,
+        description="Keep a copy of every image read for packing, images "
+        "that didn't change since are packed from this copy instead of "
+        "being read again from their (possibly remote) location.")
+    image_store_size: bpy.props.FloatProperty(
+        name="Image Cache Size (GB)",
+        default=20.0,
+        min=0.0,
+        description="The least recently used images are removed once the "
+        "image cache grows beyond this size")
+    use_texture_transcoding: bpy.props.BoolProperty(
+        name="Shrink textures",
+        default=False,
+        description="Recompress TIFF, EXR, BMP and TGA textures as PNG "
+        "or compressed EXR and downscale textures larger than the "
+        "maximum size before packing. Needs OpenImageIO (Blender 4.0+).")
+    max_texture_size: bpy.props.IntProperty(
+        name="Maximum Texture Size",
+        default=0,
+        min=0,
+        description="Largest side of packed textures in pixels, "
+        "0 keeps the resolution")
+    texture_rules: bpy.props.StringProperty(
+        name="Texture Size Rules",
+        default="",
+        description="Comma separated pattern=size rules overriding the "
+        "maximum size for textures whose name or path matches, "
+        "e.g. \"*_bg_*=2048, *hero*=0\"")
+    use_size_report: bpy.props.BoolProperty(
+        name="Analyse upload size",
+        default=False,
+        description="List what the uploaded file is made of after every "
+        "submission. The file is read once more after the upload, "
+        "compressed files are decompressed for it, which takes a while "
+        "for large scenes.")
+    scratch_dir: bpy.props.StringProperty(
+        name="Scratch Directory",
+        subtype='DIR_PATH',
+        default="",
+        description="Where scenes are prepared, a fast disk with room for "
+        "the scene and all its textures speeds up submissions. Leave "
+        "empty to use Blender's temporary directory")
+    cache_dir: bpy.props.StringProperty(
+        name="Cache Directory",
+        subtype='DIR_PATH',
+        default="",
+        description="Where prepared scenes and images are cached, leave "
+        "empty to use Blender's user data directory")
+    prepared_cache_size: bpy.props.FloatProperty(
+        name="Cache Size (GB)",
+        default=20.0,
+        min=0.0,
+        description="The least recently used scenes are removed once the "
+        "cache grows beyond this size")
+
+    def draw(self, context):
+        self.layout.prop(self, "compress_while_uploading")
+        self.layout.prop(self, "resumable_upload")
+        self.layout.prop(self, "submit_as_archive")
+        archive = self.layout.column()
+        archive.active = self.submit_as_archive
+        archive.prop(self, "archive_compression_level")
+        archive.prop(self, "archive_compression_threads")
+        archive.prop(self, "archive_chunked_upload")
+        self.layout.prop(self, "use_prepare_worker")
+        self.layout.prop(self, "prepare_timeout")
+        self.layout.prop(self, "use_prepared_cache")
+        cache = self.layout.column()
+        cache.active = self.use_prepared_cache
+        cache.prop(self, "prepared_cache_size")
+        cache.prop(self, "use_background_prepare")
+        background = cache.column()
+        background.active = self.use_background_prepare
+        background.prop(self, "background_prepare_delay")
+        self.layout.prop(self, "use_image_store")
+        image_store = self.layout.column()
+        image_store.active = self.use_image_store
+        image_store.prop(self, "image_store_size")
+        self.layout.prop(self, "use_texture_transcoding")
+        textures = self.layout.column()
+        textures.active = self.use_texture_transcoding
+        textures.prop(self, "max_texture_size")
+        textures.prop(self, "texture_rules")
+        self.layout.prop(self, "use_size_report")
+        self.layout.prop(self, "scratch_dir")
+        self.layout.prop(self, "cache_dir")
@@ -0,0 +1,207 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import os
+
+
+BLOCKER = 'BLOCKER'
+WARNING = 'WARNING'
+
+# Frames larger than this (in pixels per side) are likely to exceed the
+# memory of rendering nodes
+MAX_RESOLUTION = 16384
+
+# SheepIt! allows 30 minutes per tile. Rendering more than this many
+# samples times pixels per tile (a 1080p frame with 4096 samples) is
+# likely to exceed it on an average node.
+MAX_TILE_SAMPLE_PIXELS = 1920 * 1080 * 4096
+
+
+def issue(severity, category, message):
+    return {"severity": severity, "category": category, "message": message}
+
+
+def tiles_per_frame(scene):
+    """ Returns in how many parts every frame is rendered """
+    properties = scene.sheepit_properties
+    split_layers = scene.render.engine == 'CYCLES' and scene.use_nodes
+    if properties.type == 'frame':
+        return properties.still_layer_split if split_layers else 64
+    if split_layers:
+        return properties.anim_layer_split
+    return int(properties.anim_split) ** 2
+
+
+def check_simulations(scene):
+    """ Fluid simulations aren't supported, other simulations render wrong
+        unless they are baked into the file """
+    issues = []
+    for obj in scene.objects:
+        caches = []
+        for modifier in obj.modifiers:
+            if modifier.type == 'FLUID' and modifier.fluid_type == 'DOMAIN':
+                issues.append(issue(
+                    BLOCKER, "simulation",
+                    f"{obj.name}: fluid simulations are not supported"))
+            elif modifier.type in {'CLOTH', 'SOFT_BODY'}:
+                caches.append((modifier.name, modifier.point_cache))
+            elif modifier.type == 'DYNAMIC_PAINT' and modifier.canvas_settings:
+                for surface in modifier.canvas_settings.canvas_surfaces:
+                    caches.append((surface.name, surface.point_cache))
+        for particle_system in obj.particle_systems:
+            if particle_system.settings.type == 'EMITTER':
+                caches.append((particle_system.name,
+                               particle_system.point_cache))
+        for name, cache in caches:
+            issues += check_point_cache(f"{obj.name}: {name}", cache)
+    if scene.rigidbody_world and scene.rigidbody_world.enabled:
+        issues += check_point_cache("Rigid body world",
+                                    scene.rigidbody_world.point_cache)
+    return issues
+
+
+def check_point_cache(name, cache):
+    if cache.is_baked and cache.use_disk_cache:
+        return [issue(BLOCKER, "simulation",
+                      f"{name}: is baked to disk, disk caches are not "
+                      "uploaded")]
+    if not cache.is_baked:
+        return [issue(WARNING, "simulation",
+                      f"{name}: is not baked, every node simulates it "
+                      "again from the first frame")]
+    return []
+
+
+# Datablocks referring to an external file by their filepath
+FILE_COLLECTIONS = ("images", "movieclips", "cache_files", "sounds", "fonts",
+                    "volumes")
+
+
+def is_orphan(datablock):
+    """ Datablocks without users are purged before the scene is packed """
+    return datablock.users == 0 and not datablock.use_fake_user
+
+
+def orphan_paths():
+    """ Returns the absolute paths only used by orphan datablocks """
+    orphans = set()
+    used = set()
+    for name in FILE_COLLECTIONS:
+        for datablock in getattr(bpy.data, name, ()):
+            path = os.path.normpath(bpy.path.abspath(
+                datablock.filepath, library=datablock.library))
+            (orphans if is_orphan(datablock) else used).add(path)
+    return orphans - used
+
+
+# Datablocks whose files the render reads, a missing one of these
+# renders wrong. Other external files (sounds, movie clips used for
+# tracking, fonts, texts) don't change the rendered frames.
+RENDER_INPUTS = ("images", "libraries", "cache_files", "volumes")
+
+
+def render_input_paths():
+    """ Returns the absolute paths of the files the render reads """
+    paths = set()
+    for name in RENDER_INPUTS:
+        for datablock in getattr(bpy.data, name, ()):
+            if name != "libraries" and is_orphan(datablock):
+                continue
+            paths.add(os.path.normpath(bpy.path.abspath(
+                datablock.filepath, library=datablock.library)))
+    return paths
+
+
+def check_external_files(archive=False):
+    """ Files the render reads that aren't packed must exist, and only
+        files that can be packed reach the farm unless they are sent in
+        an archive. Other missing or unsent files are warnings. Files
+        of datablocks nobody uses are ignored, they are purged before
+        packing. """
+    issues = []
+    unused = orphan_paths()
+    inputs = render_input_paths()
+    for path in bpy.utils.blend_paths(absolute=True, packed=False,
+                                      local=False):
+        # sequences and UDIM tiles are patterns, not files
+        if "#" in path or "<" in path:
+            continue
+        path = os.path.normpath(path)
+        if path in unused or os.path.exists(path):
+            continue
+        issues.append(issue(BLOCKER if path in inputs else WARNING,
+                            "missing file", f"{path} does not exist"))
+    if archive:
+        return issues
+    for cache_file in bpy.data.cache_files:
+        if is_orphan(cache_file):
+            continue
+        issues.append(issue(
+            BLOCKER, "external file",
+            f"{cache_file.name}: {cache_file.filepath} can't be packed "
+            "and is not uploaded"))
+    for clip in bpy.data.movieclips:
+        if is_orphan(clip):
+            continue
+        # tracking data is stored in the blend file, only compositing
+        # and camera backgrounds read the clip itself
+        issues.append(issue(
+            WARNING, "external file",
+            f"{clip.name}: {clip.filepath} can't be packed and is not "
+            "uploaded, renders that show the clip will miss it"))
+    for image in bpy.data.images:
+        if image.source in {'SEQUENCE', 'MOVIE'} and \
+                not image.packed_file and not is_orphan(image):
+            issues.append(issue(
+                BLOCKER, "external file",
+                f"{image.name}: image sequences and movies can't be "
+                "packed and are not uploaded"))
+    return issues
+
+
+def check_frame(scene):
+    """ Warns about frames that are too large or too slow to render """
+    issues = []
+    render = scene.render
+    width = render.resolution_x * render.resolution_percentage // 100
+    height = render.resolution_y * render.resolution_percentage // 100
+    if max(width, height) > MAX_RESOLUTION:
+        issues.append(issue(
+            WARNING, "frame size",
+            f"{width}x{height} pixels is larger than "
+            f"{MAX_RESOLUTION} pixels per side"))
+    if render.engine == 'CYCLES':
+        samples = scene.cycles.samples
+        per_tile = width * height * samples / tiles_per_frame(scene)
+        if per_tile > MAX_TILE_SAMPLE_PIXELS:
+            issues.append(issue(
+                WARNING, "render time",
+                f"{samples} samples at {width}x{height} may exceed the "
+                "30 minutes allowed per tile, consider splitting frames "
+                "or lowering the samples"))
+    return issues
+
+
+def analyse(scene, archive=False):
+    """ Checks the open file and scene for problems that would make the
+        farm reject or mis-render the project, archive is True if
+        external files are sent next to the blend file in an archive
+
+        Returns a list of dicts with "severity" (BLOCKER or WARNING),
+        "category" and "message", blockers first """
+    issues = check_simulations(scene) + check_external_files(archive) + \
+        check_frame(scene)
+    issues.sort(key=lambda i: i["severity"] != BLOCKER)
+    return issues
@@ -0,0 +1,142 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from .sheepit import file_fingerprint
+
+
+class PreparedSceneCache():
+    """ Size limited cache of prepared blend files
+
+        Every entry is a directory named after its key, holding the
+        prepared file under its original name, so it can be uploaded
+        directly. The least recently used entries are removed once the
+        cache grows beyond max_bytes. """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(blend_file, dependencies, options=()):
+        """ Returns the cache key of blend_file prepared with options
+
+            dependencies are the absolute paths of all external files
+            the scene uses (libraries, images, caches, ...), a change to
+            any of them changes the key """
+        fingerprints = [file_fingerprint(blend_file)]
+        for path in sorted(set(dependencies)):
+            try:
+                st = os.stat(path)
+                fingerprints.append([path, st.st_size, st.st_mtime_ns])
+            except OSError:
+                fingerprints.append([path, None])
+        data = json.dumps([fingerprints, list(options)])
+        return hashlib.blake2b(data.encode("utf-8"),
+                               digest_size=20).hexdigest()
+
+    def lookup(self, key, name):
+        """ Returns the path of the cached file, or None on a miss """
+        entry = os.path.join(self.directory, key)
+        path = os.path.join(entry, name)
+        if not os.path.isfile(path):
+            return None
+        # mark as recently used
+        os.utime(entry)
+        return path
+
+    def store(self, key, name, path, move=False):
+        """ Copies the prepared file at path into the cache, or moves it
+            there if move """
+        entry = os.path.join(self.directory, key)
+        tmp_entry = f"{entry}.tmp"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        target = os.path.join(tmp_entry, name)
+        if move:
+            try:
+                os.replace(path, target)
+            except OSError:
+                # the cache is on another file system
+                shutil.copyfile(path, target)
+        else:
+            shutil.copyfile(path, target)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_entry, entry)
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache is
+            smaller than max_bytes """
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if not os.path.isdir(entry) or key.endswith(".tmp"):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name))
+                       for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        entries.sort()
+        while entries and total > self.max_bytes:
+            mtime, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class PrepareHistory():
+    """ Rolling history of prepare_scene.py results in a JSON file, to
+        compare preparation times between runs and Blender versions """
+
+    def __init__(self, path, max_entries=200):
+        self.path = path
+        self.max_entries = max_entries
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def add(self, result):
+        entries = self.load()
+        entries.append(dict(result, prepared=time.time()))
+        del entries[:-self.max_entries]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def summary(self, file):
+        """ Returns a dict mapping every Blender version that prepared
+            file without error to its mean time per step in seconds """
+        steps = dict()
+        for entry in self.load():
+            if entry.get("file") != file or entry.get("error"):
+                continue
+            version = steps.setdefault(entry.get("blender_version"), [])
+            version.append(entry.get("steps", {}))
+        return {
+            version: {name: sum(run.get(name, 0.0) for run in runs)
+                      / len(runs)
+                      for name in runs[-1]}
+            for version, runs in steps.items()
+        }
@@ -13,38 +13,538 @@
 
 
 import bpy
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import contextlib
+import re
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from image_store import ImageStore
+import transcode
 
-def main():
-    had_error = False
-    error_text = ""
+
+def script_args():
+    """ Returns the arguments passed to this script after "--" """
+    if "--" in sys.argv:
+        return sys.argv[sys.argv.index("--") + 1:]
+    return []
+
+
+def parse_options(args):
+    """ Parses the options of this script, see script_args() """
+    parser = argparse.ArgumentParser(prog="prepare_scene.py")
+    # run the job loop, see worker_loop()
+    parser.add_argument("--worker", action="store_true")
+    # where the prepared scene is written, required outside the worker
+    # loop, the open file is never overwritten
+    parser.add_argument("--output", default="")
+    # the uploader compresses the file itself while sending it
+    parser.add_argument("--uncompressed", action="store_true")
+    # directory and size in bytes of the ImageStore used for packing
+    parser.add_argument("--image-store", default="")
+    parser.add_argument("--image-store-size", type=int,
+                        default=20 * 1024**3)
+    # directory of the transcoded images, enables transcoding
+    parser.add_argument("--transcode-dir", default="")
+    # largest side of transcoded images in pixels, 0 keeps the resolution
+    parser.add_argument("--max-texture-size", type=int, default=0)
+    # "pattern=size" overriding --max-texture-size for matching images
+    parser.add_argument("--texture-rule", action="append", default=[])
+    # directory of the original file, external files that can't be
+    # packed are pointed into a ZIP archive laid out relative to it
+    parser.add_argument("--archive-root", default="")
+    return parser.parse_args(args)
+
+
+def id_collections(exclude=()):
+    """ Yields every bpy.data collection that holds datablocks, except
+        the ones named in exclude """
+    for name in dir(bpy.data):
+        collection = getattr(bpy.data, name, None)
+        if isinstance(collection, bpy.types.bpy_prop_collection) and \
+                hasattr(collection, "remove") and \
+                name not in {"window_managers", "screens", "workspaces",
+                             "scenes", "texts"} and name not in exclude:
+            yield collection
+
+
+def datablock_stats():
+    """ Returns the number of datablocks and the size of their
+        packed data in bytes """
+    count = 0
+    packed_bytes = 0
+    for collection in id_collections():
+        for datablock in collection:
+            count += 1
+            packed_file = getattr(datablock, "packed_file", None)
+            if packed_file:
+                packed_bytes += packed_file.size
+    return count, packed_bytes
+
+
+def purge_orphans():
+    """ Removes datablocks without users until none are left, since
+        removing a datablock can orphan the ones it used
+
+        Returns the number of removed datablocks, the size of the packed
+        data they held in bytes and the time it took in seconds """
+    start = time.perf_counter()
+    count, packed_bytes = datablock_stats()
+    if hasattr(bpy.data, "orphans_purge"):
+        # Blender 3.2+
+        bpy.data.orphans_purge(do_recursive=True)
+    while True:
+        # like Blender's purge, libraries are never orphans: removing one
+        # removes everything linked from it. Linked datablocks are left
+        # to their library.
+        orphans = [
+            datablock
+            for collection in id_collections(exclude={"libraries"})
+            for datablock in collection
+            if datablock.users == 0 and not datablock.use_fake_user
+            and datablock.library is None
+        ]
+        if not orphans:
+            break
+        bpy.data.batch_remove(orphans)
+    count_after, packed_bytes_after = datablock_stats()
+    return (count - count_after, packed_bytes - packed_bytes_after,
+            time.perf_counter() - start)
+
+
+def file_digest(path, store=None, block_size=1024 * 1024):
+    """ Returns the SHA-256 hex digest of the file at path, or None if it
+        can't be read. Files the ImageStore store read before are only
+        hashed again if they changed since. """
+    if store:
+        digest = store.digest(path)
+        if digest:
+            return digest
+    hasher = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                hasher.update(block)
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+
+def image_key(image, digests, store=None):
+    """ Returns a key that is equal for images showing the same pixels,
+        or None if the image can't be merged with others
+
+        digests caches the digests of the files already hashed """
+    if image.source not in {'FILE', 'MOVIE'}:
+        return None
+    if image.packed_file:
+        digest = hashlib.sha256(image.packed_file.data).hexdigest()
+        size = image.packed_file.size
+    else:
+        path = os.path.normpath(
+            bpy.path.abspath(image.filepath, library=image.library))
+        if path not in digests:
+            digests[path] = file_digest(path, store)
+        if digests[path] is None:
+            return None
+        digest = digests[path]
+        size = os.path.getsize(path)
+    # images reading the same bytes differently must stay separate
+    return (digest, size, image.source, image.colorspace_settings.name,
+            image.alpha_mode, image.use_view_as_render)
+
+
+def collapse_duplicate_images(digests, store=None):
+    """ Remaps the users of image datablocks with the same content onto
+        a single datablock, so it is only packed once
+
+        digests maps the paths of hashed files to their digests, it is
+        filled for later steps. Returns the number of collapsed images
+        and the bytes saved """
+    canonical = dict()
+    count = 0
+    saved_bytes = 0
+    for image in list(bpy.data.images):
+        key = image_key(image, digests, store)
+        if key is None:
+            continue
+        if key not in canonical:
+            canonical[key] = image
+            continue
+        image.user_remap(canonical[key])
+        count += 1
+        saved_bytes += key[1]
+    return count, saved_bytes
+
+
+def collapse_duplicate_libraries():
+    """ Remaps datablocks linked from libraries with the same content onto
+        the ones linked from the first of them
+
+        Returns the number of collapsed libraries and the size of their
+        files in bytes """
+    canonical = dict()
+    duplicates = dict()
+    for library in bpy.data.libraries:
+        path = os.path.normpath(bpy.path.abspath(library.filepath))
+        digest = file_digest(path)
+        if digest is None:
+            continue
+        if digest in canonical:
+            duplicates[library] = canonical[digest]
+        else:
+            canonical[digest] = library
+    if not duplicates:
+        return 0, 0
+    saved_bytes = sum(os.path.getsize(bpy.path.abspath(library.filepath))
+                      for library in duplicates)
+    for collection in id_collections():
+        linked = {(datablock.library, datablock.name): datablock
+                  for datablock in collection if datablock.library}
+        for (library, name), datablock in linked.items():
+            target = linked.get((duplicates.get(library), name))
+            if target is not None:
+                datablock.user_remap(target)
+    return len(duplicates), saved_bytes
+
+
+# Prefix of the progress lines written to stdout, followed by a JSON
+# object {"step": name, "index": n, "steps": count, "item": n,
+# "total": count, "bytes": packed}
+PROGRESS_PREFIX = "SHEEPIT-PROGRESS "
+
+# The steps of prepare() in order
+STEPS = ("select", "collapse_duplicates", "make_local", "purge_orphans",
+         "transcode", "pack_images", "pack_all", "relocate", "save")
+
+
+def progress(step, item=0, total=0, bytes_done=0):
+    """ Writes a progress event for the uploader, item of total items of
+        step are done and bytes_done bytes were packed """
+    event = {"step": step, "index": STEPS.index(step), "steps": len(STEPS),
+             "item": item, "total": total, "bytes": bytes_done}
+    sys.stdout.write(PROGRESS_PREFIX + json.dumps(event) + "\n")
+    sys.stdout.flush()
+
+
+def file_images():
+    """ Yields the local images that are read from a single file """
+    for image in bpy.data.images:
+        if image.packed_file or image.library or \
+                image.source != 'FILE' or not image.filepath:
+            continue
+        yield image
+
+
+def transcode_images(options, digests, store=None):
+    """ Points images at recompressed or downscaled copies, see
+        transcode.run_transcoder(), digests are the known digests of
+        image files
+
+        Returns the number of replaced images and their size in bytes
+        before and after """
+    images = dict()
+    for image in file_images():
+        path = os.path.normpath(bpy.path.abspath(image.filepath))
+        if os.path.isfile(path):
+            images.setdefault(path, []).append(image)
+    known_digests = dict()
+    for path in images:
+        digest = digests.get(path) or (store and store.digest(path))
+        if digest:
+            known_digests[path] = digest
+    results = transcode.run_transcoder(
+        images, options.transcode_dir,
+        rules=transcode.parse_rules(options.texture_rule),
+        max_size=options.max_texture_size,
+        digests=known_digests,
+        callback=lambda done, result: progress(
+            "transcode", done, len(images), result["bytes_out"]))
+    count = 0
+    bytes_in = 0
+    bytes_out = 0
+    for path, result in results.items():
+        if result["path"] == path:
+            continue
+        for image in images[path]:
+            # changing the file resets the colour space
+            colorspace = image.colorspace_settings.name
+            image.filepath = result["path"]
+            image.colorspace_settings.name = colorspace
+        count += 1
+        bytes_in += result["bytes_in"]
+        bytes_out += result["bytes_out"]
+    return count, bytes_in, bytes_out
+
+
+def sequence_files(path):
+    """ Returns the files of the sequence path belongs to, files whose
+        names only differ from it in the last number """
+    directory, name = os.path.split(path)
+    match = None
+    for match in re.finditer(r"\d+", name):
+        pass
+    if match is None:
+        return [path]
+    pattern = re.compile(re.escape(name[:match.start()]) + r"\d+"
+                         + re.escape(name[match.end():]) + "$")
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(os.path.join(directory, n) for n in names
+                  if pattern.match(n))
+
+
+def relocate_external_files(root):
+    """ Points the external files that can't be packed into an archive
+        laid out relative to root
+
+        Files below root keep their path relative to it, others are
+        placed in "external/". Returns the (path, arcname) tuples of all
+        files the archive needs next to the blend file. """
+    members = dict()
+
+    def relocate(filepath, is_sequence):
+        path = os.path.normpath(bpy.path.abspath(filepath))
+        relative = os.path.relpath(path, root) \
+            if os.path.splitdrive(path)[0] == os.path.splitdrive(root)[0] \
+            else os.pardir
+        if relative.startswith(os.pardir):
+            directory = hashlib.sha1(
+                os.path.dirname(path).encode("utf-8")).hexdigest()[:8]
+            relative = os.path.join("external", directory,
+                                    os.path.basename(path))
+        files = sequence_files(path) if is_sequence else [path]
+        for file in files:
+            if os.path.isfile(file):
+                members[file] = os.path.join(os.path.dirname(relative),
+                                             os.path.basename(file))
+        return "//" + relative.replace(os.sep, "/")
+
+    for cache_file in bpy.data.cache_files:
+        if not cache_file.library:
+            cache_file.filepath = relocate(cache_file.filepath,
+                                           cache_file.is_sequence)
+    for clip in bpy.data.movieclips:
+        if not clip.library:
+            clip.filepath = relocate(clip.filepath,
+                                     clip.source == 'SEQUENCE')
+    for volume in bpy.data.volumes:
+        if not volume.library and not volume.packed_file:
+            volume.filepath = relocate(volume.filepath, volume.is_sequence)
+    for image in bpy.data.images:
+        if not image.library and not image.packed_file and \
+                image.source in {'SEQUENCE', 'MOVIE'}:
+            image.filepath = relocate(image.filepath,
+                                      image.source == 'SEQUENCE')
+    return sorted(members.items())
+
+
+def pack_images(store):
+    """ Packs all local file images, unchanged ones are loaded from
+        the ImageStore store instead of their source
+
+        Returns a list with the path, the time it took and the number of
+        bytes read from the source for every packed image """
+    stats = []
+    images = list(file_images())
+    bytes_done = 0
+    for item, image in enumerate(images):
+        progress("pack_images", item, len(images), bytes_done)
+        # normalized like the paths hashed by the earlier steps, so they
+        # find the store's index entries
+        path = os.path.normpath(bpy.path.abspath(image.filepath))
+        if not os.path.isfile(path):
+            continue
+        start = time.perf_counter()
+        data, from_store = store.read(path)
+        image.pack(data=data, data_len=len(data))
+        bytes_done += len(data)
+        stats.append({"image": image.name,
+                      "path": path,
+                      "from_store": from_store,
+                      "bytes_read": 0 if from_store else len(data),
+                      "seconds": time.perf_counter() - start})
+    store.save()
+    return stats
+
+
+@contextlib.contextmanager
+def step(result, name):
+    """ Records the wall time of the with block in result["steps"] and
+        reports the start of step name """
+    progress(name)
+    start = time.perf_counter()
     try:
-        # Go to object mode
-        bpy.ops.object.mode_set(mode='OBJECT')
-        # Select all
-        bpy.ops.object.select_all(action="SELECT")
+        yield
+    finally:
+        result["steps"][name] = time.perf_counter() - start
+
+
+def prepare(output_path, options=None):
+    """ Prepares the open scene for the farm and saves it to output_path
+
+        Returns a result dict with an error message ("" on success), the
+        wall time of every step in seconds, the number of datablocks and
+        packed bytes after preparation, the output file size and
+        statistics of the steps that change the scene
+
+        Raises:
+        ValueError without output_path, the open file is the artist's
+        own and must not be saved over """
+    if not output_path:
+        raise ValueError("No output path for the prepared scene")
+    options = options or parse_options([])
+    result = {
+        "error": "",
+        "blender_version": bpy.app.version_string,
+        "file": os.path.basename(output_path),
+        "steps": dict(),
+        "datablocks": 0,
+        "packed_bytes": 0,
+        "output_size": 0,
+        "peak_memory": None,
+    }
+    start = time.perf_counter()
+    try:
+        # the store's index also spares hashing unchanged images
+        store = None
+        if options.image_store:
+            store = ImageStore(options.image_store,
+                               options.image_store_size)
+        digests = dict()
+        with step(result, "select"):
+            # Go to object mode
+            bpy.ops.object.mode_set(mode='OBJECT')
+            # Select all
+            bpy.ops.object.select_all(action="SELECT")
+        # Collapse identical images and libraries, the duplicates are
+        # left without users and purged below
+        with step(result, "collapse_duplicates"):
+            images, image_bytes = collapse_duplicate_images(digests, store)
+            libraries, library_bytes = collapse_duplicate_libraries()
+        result["duplicates"] = {"images": images,
+                                "image_bytes": image_bytes,
+                                "libraries": libraries,
+                                "library_bytes": library_bytes}
         # Make all linked models local
-        bpy.ops.object.make_local(type='ALL')
-        # Purge all (reload file because orphans_purge is not working)
-        bpy.ops.wm.save_as_mainfile(compress=False)
-        for i in range(3):
-            bpy.ops.wm.revert_mainfile()
+        with step(result, "make_local"):
+            bpy.ops.object.make_local(type='ALL')
+        # Purge all orphans, so they don't get packed
+        with step(result, "purge_orphans"):
+            removed, removed_bytes, seconds = purge_orphans()
+        result["orphans"] = {"datablocks": removed,
+                             "packed_bytes": removed_bytes}
+        # Recompress and downscale images
+        if options.transcode_dir:
+            if transcode.available():
+                with step(result, "transcode"):
+                    count, bytes_in, bytes_out = transcode_images(
+                        options, digests, store)
+                result["transcoded"] = {"images": count,
+                                        "bytes_in": bytes_in,
+                                        "bytes_out": bytes_out}
+            else:
+                print("Skipped transcoding, OpenImageIO is not available")
+        # Pack images through the store, unchanged images are not read
+        # again from their (possibly remote) source
+        if store:
+            with step(result, "pack_images"):
+                images = pack_images(store)
+            for image in images:
+                print(f"Packed {image['path']} "
+                      f"({'store' if image['from_store'] else 'source'}, "
+                      f"{image['seconds']:.2f}s)")
+            result["image_store"] = {
+                "count": len(images),
+                "from_store": sum(i["from_store"] for i in images),
+                "bytes_read": sum(i["bytes_read"] for i in images),
+                "images": images}
         # Pack all Textures
-        bpy.ops.file.pack_all()
+        with step(result, "pack_all"):
+            bpy.ops.file.pack_all()
+        result["datablocks"], result["packed_bytes"] = datablock_stats()
+        # Point what couldn't be packed into the archive, the paths must
+        # stay relative to the archive when saving
+        if options.archive_root:
+            with step(result, "relocate"):
+                result["archive_members"] = relocate_external_files(
+                    options.archive_root)
         # And save
-        bpy.ops.wm.save_as_mainfile(compress=True)
-
+        with step(result, "save"):
+            bpy.ops.wm.save_as_mainfile(
+                filepath=output_path,
+                compress=not options.uncompressed,
+                relative_remap=not options.archive_root)
+        result["output_size"] = os.path.getsize(output_path)
     except Exception as e:
-        error_text = e
-        had_error = True
-    # Generate Log file
-    blend_file = bpy.data.filepath
-    with open(f"{blend_file}.log", "w") as f:
-        f.write("ERR" if had_error else "OK")
-        if had_error:
-            # write Error
-            f.write(f"<->{error_text}")
+        result["error"] = str(e) or type(e).__name__
+    result["steps"]["total"] = time.perf_counter() - start
+    result["peak_memory"] = peak_memory()
+    print("SheepIt! prepared scene: " + json.dumps(result))
+    return result
+
+
+def peak_memory():
+    """ Returns the peak memory use of this process in bytes,
+        or None if the platform can't tell """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
 
 
+# Prefix of the result lines written by the worker loop, everything else
+# on stdout is Blender's own output
+RESULT_PREFIX = "SHEEPIT-RESULT "
+
+
+def worker_loop():
+    """ Prepares one file per JSON line read from stdin:
+        {"source": path, "output": path, "args": [option, ...]}
+
+        For every job a line with RESULT_PREFIX and the JSON result of
+        prepare() is written to stdout. Stops at the end of stdin. """
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        try:
+            if not job.get("output"):
+                raise ValueError("Job without an output path")
+            bpy.ops.wm.open_mainfile(filepath=job["source"], load_ui=False)
+            result = prepare(job["output"],
+                             parse_options(job.get("args", [])))
+        except Exception as e:
+            result = {"error": str(e) or type(e).__name__,
+                      "peak_memory": peak_memory()}
+        sys.stdout.write(RESULT_PREFIX + json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+def main():
+    options = parse_options(script_args())
+    if options.worker:
+        worker_loop()
+        return
+    if not options.output:
+        sys.exit("prepare_scene.py: --output is required")
+    output_path = options.output
+    result = prepare(output_path, options)
+    # Write the result next to the prepared file, written to a temporary
+    # name first so a half written result is never read
+    tmp_path = f"{output_path}.result.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, f"{output_path}.result.json")
+
 if __name__ == "__main__":
     main()
@@ -13,18 +13,22 @@
 
 
 import bpy
+import json
 from . import sheepit
+from . import preflight
 
 
 def register():
     bpy.utils.register_class(LoginPanel)
     bpy.utils.register_class(AddProjectPanel)
+    bpy.utils.register_class(SizeReportPanel)
     bpy.utils.register_class(ProfilePanel)
 
 
 def unregister():
     bpy.utils.unregister_class(LoginPanel)
     bpy.utils.unregister_class(AddProjectPanel)
+    bpy.utils.unregister_class(SizeReportPanel)
     bpy.utils.unregister_class(ProfilePanel)
 
 
@@ -123,7 +127,18 @@ class AddProjectPanel(SheepItRenderPanel, bpy.types.Panel):
                             text="If you split frames, compositor and "
                             "denoising will be disabled.")
 
-            self.layout.operator("sheepit.send_project")
+            row = self.layout.row(align=True)
+            row.operator("sheepit.send_project")
+            row.operator("sheepit.check_scene")
+            # problems found by the last check
+            if 'sheepit' in bpy.context.window_manager and \
+                    'preflight' in bpy.context.window_manager['sheepit']:
+                issues = json.loads(
+                    bpy.context.window_manager['sheepit']['preflight'])
+                for issue in issues:
+                    icon = 'CANCEL' if issue["severity"] == \
+                        preflight.BLOCKER else 'ERROR'
+                    self.layout.label(text=issue["message"], icon=icon)
             status = ""
             progress = ""
             # status
@@ -157,6 +172,40 @@ class AddProjectPanel(SheepItRenderPanel, bpy.types.Panel):
                 text="SheepIt is only compatible with Eevee or Cycles")
 
 
+class SizeReportPanel(SheepItRenderPanel, bpy.types.Panel):
+    """ What the last uploaded file is made of, shown under the Submit
+        Panel after an upload """
+    bl_idname = "SHEEPIT_PT_size_report_panel"
+    bl_parent_id = "SHEEPIT_PT_add_project"
+    bl_label = "Upload Size"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    @classmethod
+    def poll(cls, context):
+        return 'sheepit' in bpy.context.window_manager and \
+            'size_categories' in bpy.context.window_manager['sheepit']
+
+    def draw(self, context):
+        report = bpy.context.window_manager['sheepit']
+        grid = self.layout.grid_flow(row_major=True, columns=3,
+                                    even_columns=True)
+        grid.label(text="")
+        grid.label(text="Size")
+        grid.label(text="Compressed")
+        for total in json.loads(report['size_categories']):
+            grid.label(text=f"{total['category']} ({total['count']})")
+            grid.label(text=f"{total['bytes'] / 1e6:.1f} MB")
+            grid.label(text=f"{total['compressed_bytes'] / 1e6:.1f} MB")
+        self.layout.label(text="Largest datablocks:")
+        grid = self.layout.grid_flow(row_major=True, columns=3,
+                                    even_columns=True)
+        for entry in json.loads(report['size_top']):
+            grid.label(text=entry["name"])
+            grid.label(text=f"{entry['bytes'] / 1e6:.1f} MB")
+            grid.label(text=f"{entry['compressed_bytes'] / 1e6:.1f} MB")
+        self.layout.operator("sheepit.export_size_report")
+
+
 class ProfilePanel(SheepItRenderPanel, bpy.types.Panel):
     """ Profile Panel shown under the Submit Panel
         Used for Userinfo, logout and other Profile operations """
@@ -8,7 +8,7 @@ See http://toolbelt.rtfd.org/ for documentation
 :license: Apache v2.0, see LICENSE for more details
 """
 
-from .encoder import MultipartEncoder, MultipartEncoderMonitor
+from .encoder import BlockIterator, MultipartEncoder, MultipartEncoderMonitor
 from .decoder import MultipartDecoder
 from .decoder import ImproperBodyPartContentException
 from .decoder import NonMultipartContentTypeException
@@ -19,6 +19,7 @@ __license__ = 'Apache v2.0'
 __copyright__ = 'Copyright 2014 Ian Cordasco, Cory Benfield'
 
 __all__ = [
+    'BlockIterator',
     'MultipartEncoder',
     'MultipartEncoderMonitor',
     'MultipartDecoder',
@@ -8,8 +8,12 @@ This holds all of the implementation details of the MultipartEncoder
 
 """
 import contextlib
+import hashlib
 import io
+import mmap
 import os
+import stat
+import time
 from uuid import uuid4
 
 import requests
@@ -17,6 +21,10 @@ import requests
 from .._compat import fields
 
 
+#: Default size of the blocks produced when iterating over an encoder
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+
 class FileNotSupportedError(Exception):
     """File not supported error."""
 
@@ -74,17 +82,38 @@ class MultipartEncoder(object):
         This object will end up directly in :mod:`httplib`. Currently,
         :mod:`httplib` has a hard-coded read size of **8192 bytes**. This
         means that it will loop until the file has been read and your upload
-        could take a while. This is **not** a bug in requests. A feature is
-        being considered for this object to allow you, the user, to specify
-        what size should be returned on a read. If you have opinions on this,
-        please weigh in on `this issue`_.
+        could take a while. This is **not** a bug in requests. To send larger
+        writes, wrap the encoder in a :class:`BlockIterator`, which makes
+        :mod:`httplib` iterate over blocks of ``block_size`` bytes instead:
+
+        .. code-block:: python
+
+            encoder = MultipartEncoder(fields, block_size=4 * 1024 * 1024)
+            r = requests.post('https://httpbin.org/post',
+                              data=BlockIterator(encoder),
+                              headers={'Content-Type': encoder.content_type})
+
+        See also `this issue`_.
+
+    To checksum the parts while they are streamed, pass the name of a
+    :mod:`hashlib` algorithm as ``hash_name``. Once the encoder is finished,
+    :attr:`digests` maps every field name to the hex digest of its body, at
+    no extra I/O:
+
+    .. code-block:: python
+
+        encoder = MultipartEncoder(fields, hash_name='sha256')
+        r = requests.post(url, data=encoder,
+                          headers={'Content-Type': encoder.content_type})
+        encoder.digests['file_field']
 
     .. _this issue:
         https://github.com/requests/toolbelt/issues/75
 
     """
 
-    def __init__(self, fields, boundary=None, encoding='utf-8'):
+    def __init__(self, fields, boundary=None, encoding='utf-8',
+                 block_size=DEFAULT_BLOCK_SIZE, hash_name=None):
         #: Boundary value either passed in by the user or created
         self.boundary_value = boundary or uuid4().hex
 
@@ -94,6 +123,12 @@ class MultipartEncoder(object):
         #: Encoding of the data being passed in
         self.encoding = encoding
 
+        #: Size of the blocks produced when iterating over the encoder
+        self.block_size = block_size
+
+        #: Name of the :mod:`hashlib` algorithm used to hash each part
+        self.hash_name = hash_name
+
         # Pre-encoded boundary
         self._encoded_boundary = b''.join([
             encode_with(self.boundary, self.encoding),
@@ -150,6 +185,20 @@ class MultipartEncoder(object):
     def __repr__(self):
         return '<MultipartEncoder: {0!r}>'.format(self.fields)
 
+    @property
+    def digests(self):
+        """Hex digests of the part bodies, by field name.
+
+        Only complete once the encoder is finished. Parts that were partly
+        skipped with :meth:`skip` have no digest (``None``), as do all parts
+        if no ``hash_name`` was given.
+        """
+        return dict((p.name, p.hash and p.hash.hexdigest())
+                    for p in self.parts)
+
+    def __iter__(self):
+        return iter_blocks(self, self.block_size)
+
     def _calculate_length(self):
         """
         This uses the parts to calculate the length of the body.
@@ -191,6 +240,7 @@ class MultipartEncoder(object):
         while amount == -1 or amount > 0:
             written = 0
             if part and not part.bytes_left_to_write():
+                part.close()
                 written += self._write(b'\r\n')
                 written += self._write_boundary()
                 part = self._next_part()
@@ -243,7 +293,8 @@ class MultipartEncoder(object):
         generator for iteration.
         """
         enc = self.encoding
-        self.parts = [Part.from_field(f, enc) for f in self._iter_fields()]
+        self.parts = [Part.from_field(f, enc, self.hash_name)
+                      for f in self._iter_fields()]
         self._iter_parts = iter(self.parts)
 
     def _write(self, bytes_to_write):
@@ -276,6 +327,16 @@ class MultipartEncoder(object):
             'multipart/form-data; boundary={0}'.format(self.boundary_value)
             )
 
+    def close(self):
+        """Release the memory maps of file parts.
+
+        File objects passed in the fields are not closed. Parts are
+        released automatically once they have been read completely, this
+        releases the rest, e.g. after a failed upload.
+        """
+        for part in self.parts:
+            part.close()
+
     def to_string(self):
         """Return the entirety of the data in the encoder.
 
@@ -309,11 +370,62 @@ class MultipartEncoder(object):
 
         bytes_to_load = size
         if bytes_to_load != -1 and bytes_to_load is not None:
+            view = self._read_view(int(size))
+            if view is not None:
+                return view
             bytes_to_load = self._calculate_load_amount(int(size))
 
         self._load(bytes_to_load)
         return self._buffer.read(size)
 
+    def skip(self, amount):
+        """Discard the next ``amount`` bytes of the body.
+
+        File parts are skipped by moving their position, so resuming an
+        upload in the middle of a large file does not read the skipped part
+        of it.
+
+        :param int amount: the number of bytes to discard
+        :returns: int -- the number of bytes actually discarded
+        """
+        skipped = 0
+        while skipped < amount:
+            part = self._current_part
+            if (part is not None and not part.headers_unread and
+                    total_len(self._buffer) == 0 and
+                    hasattr(part.body, 'skip')):
+                count = part.body.skip(amount - skipped)
+                if count:
+                    # the skipped bytes were never hashed
+                    part.hash = None
+                    skipped += count
+                    continue
+            chunk = self.read(min(amount - skipped, self.block_size))
+            if not chunk:
+                break
+            skipped += len(chunk)
+        return skipped
+
+    def _read_view(self, size):
+        """Read directly from a memory-mapped part, bypassing the buffer.
+
+        This is only possible while the buffer is drained and the current
+        part's headers have already been written, otherwise the bytes would
+        be returned out of order.
+
+        :param int size: the number of bytes the consumer requests
+        :returns: memoryview or None if the buffer has to be used
+        """
+        part = self._current_part
+        if (part is None or part.headers_unread or size <= 0 or
+                not isinstance(part.body, MmapFileWrapper) or
+                total_len(self._buffer) > 0 or total_len(part.body) <= 0):
+            return None
+        view = part.body.read(size)
+        if part.hash is not None:
+            part.hash.update(view)
+        return view
+
 
 def IDENTITY(monitor):
     return monitor
@@ -368,9 +480,26 @@ class MultipartEncoderMonitor(object):
         r = requests.post('https://httpbin.org/post', data=monitor,
                           headers=headers)
 
+    To avoid calling the callback for every single read, pass ``min_bytes``
+    and/or ``min_interval``. The callback is then called once at least
+    ``min_bytes`` bytes were read or ``min_interval`` seconds passed since
+    the last call, whichever comes first, and always once more when the last
+    byte was read. Each call also updates :attr:`throughput` and
+    :attr:`eta`.
+
+    .. code-block:: python
+
+        def callback(monitor):
+            print(monitor.bytes_read, monitor.throughput, monitor.eta)
+
+        monitor = MultipartEncoderMonitor(m, callback,
+                                          min_bytes=1024 * 1024,
+                                          min_interval=0.5)
+
     """
 
-    def __init__(self, encoder, callback=None):
+    def __init__(self, encoder, callback=None, min_bytes=0, min_interval=0,
+                 smoothing=0.3):
         #: Instance of the :class:`MultipartEncoder` being monitored
         self.encoder = encoder
 
@@ -384,6 +513,24 @@ class MultipartEncoderMonitor(object):
         #: Avoid the same problem in bug #80
         self.len = self.encoder.len
 
+        #: Minimum number of bytes read between two callbacks, 0 to disable
+        self.min_bytes = min_bytes
+
+        #: Minimum number of seconds between two callbacks, 0 to disable
+        self.min_interval = min_interval
+
+        #: Weight of the newest sample in :attr:`throughput`
+        self.smoothing = smoothing
+
+        #: Exponentially weighted moving average of the read rate in bytes
+        #: per second, updated on every callback
+        self.throughput = 0.0
+
+        # State at the last callback
+        self._last_bytes = None
+        self._last_time = time.monotonic()
+        self._done = False
+
     @classmethod
     def from_fields(cls, fields, boundary=None, encoding='utf-8',
                     callback=None):
@@ -394,15 +541,95 @@ class MultipartEncoderMonitor(object):
     def content_type(self):
         return self.encoder.content_type
 
+    @property
+    def block_size(self):
+        return self.encoder.block_size
+
+    @property
+    def eta(self):
+        """Estimated number of seconds left, ``None`` if unknown."""
+        if not self.throughput:
+            return None
+        return max(self.len - self.bytes_read, 0) / self.throughput
+
+    def __iter__(self):
+        return iter_blocks(self, self.block_size)
+
     def to_string(self):
         return self.read()
 
     def read(self, size=-1):
         string = self.encoder.read(size)
+        if self._last_bytes is None:
+            # bytes_read may start at an offset, e.g. for resumed uploads
+            self._last_bytes = self.bytes_read
         self.bytes_read += len(string)
-        self.callback(self)
+        if not (self.min_bytes or self.min_interval):
+            self.callback(self)
+        else:
+            self._throttled_callback()
         return string
 
+    def _throttled_callback(self):
+        if self._done:
+            return
+        now = time.monotonic()
+        delta = self.bytes_read - self._last_bytes
+        elapsed = now - self._last_time
+        self._done = self.bytes_read >= self.len
+        if not (self._done or
+                (self.min_bytes and delta >= self.min_bytes) or
+                (self.min_interval and elapsed >= self.min_interval)):
+            return
+        if elapsed > 0 and delta > 0:
+            rate = delta / elapsed
+            if self.throughput:
+                rate = (self.smoothing * rate +
+                        (1 - self.smoothing) * self.throughput)
+            self.throughput = rate
+        self._last_bytes = self.bytes_read
+        self._last_time = now
+        self.callback(self)
+
+
+class BlockIterator(object):
+
+    """
+    Make requests send a :class:`MultipartEncoder` in large blocks.
+
+    :mod:`httplib` prefers ``read`` over iteration and always reads 8192
+    bytes at a time. This wrapper deliberately only exposes ``__iter__`` and
+    ``len``, so the body is written to the socket in blocks of
+    ``block_size`` bytes while requests can still send a
+    ``Content-Length`` header.
+
+    :param body: a :class:`MultipartEncoder` or
+        :class:`MultipartEncoderMonitor`
+    :param int block_size: (optional), overrides the ``block_size`` of
+        ``body``
+    """
+
+    def __init__(self, body, block_size=None):
+        self.body = body
+        self.block_size = block_size or body.block_size
+        self.len = body.len
+
+    @property
+    def content_type(self):
+        return self.body.content_type
+
+    def __iter__(self):
+        return iter_blocks(self.body, self.block_size)
+
+
+def iter_blocks(body, block_size):
+    """Read ``body`` in blocks of ``block_size`` bytes until it is empty."""
+    while True:
+        block = body.read(block_size)
+        if not block:
+            return
+        yield block
+
 
 def encode_with(string, encoding):
     """Encoding ``string`` with ``encoding`` if necessary.
@@ -466,6 +693,8 @@ def coerce_data(data, encoding):
             return CustomBytesIO(data.getvalue(), encoding)
 
         if hasattr(data, 'fileno'):
+            if MmapFileWrapper.supports(data):
+                return MmapFileWrapper(data)
             return FileWrapper(data)
 
         if not hasattr(data, 'read'):
@@ -481,18 +710,25 @@ def to_list(fields):
 
 
 class Part(object):
-    def __init__(self, headers, body):
+    def __init__(self, headers, body, name=None, hash_name=None):
         self.headers = headers
         self.body = body
+        self.name = name
+        self.hash = hashlib.new(hash_name) if hash_name else None
         self.headers_unread = True
         self.len = len(self.headers) + total_len(self.body)
 
     @classmethod
-    def from_field(cls, field, encoding):
+    def from_field(cls, field, encoding, hash_name=None):
         """Create a part from a Request Field generated by urllib3."""
         headers = encode_with(field.render_headers(), encoding)
         body = coerce_data(field.data, encoding)
-        return cls(headers, body)
+        return cls(headers, body, field._name, hash_name)
+
+    def close(self):
+        """Release the body if it is memory mapped."""
+        if isinstance(self.body, MmapFileWrapper):
+            self.body.close()
 
     def bytes_left_to_write(self):
         """Determine if there are bytes left to write.
@@ -525,7 +761,10 @@ class Part(object):
             amount_to_read = size
             if size != -1:
                 amount_to_read = size - written
-            written += buffer.append(self.body.read(amount_to_read))
+            data = self.body.read(amount_to_read)
+            if self.hash is not None:
+                self.hash.update(data)
+            written += buffer.append(data)
 
         return written
 
@@ -575,6 +814,99 @@ class FileWrapper(object):
     def read(self, length=-1):
         return self.fd.read(length)
 
+    def skip(self, length):
+        length = max(min(length, self.len), 0)
+        self.fd.seek(length, 1)
+        return length
+
+
+class MmapFileWrapper(object):
+    """Read-only memory map of a regular file.
+
+    Reads return :class:`memoryview` slices of the mapping instead of
+    ``bytes``, so the :class:`MultipartEncoder` can pass the file contents to
+    the socket without copying them through its buffer first. Reading starts
+    at the current position of ``file_object``, which itself is never moved.
+
+    The file is only mapped once its contents are read, so computing the
+    length of an encoder doesn't map it. :meth:`close` unmaps it, this
+    happens automatically once the file has been read completely.
+    """
+
+    def __init__(self, file_object):
+        self.fd = file_object
+        self._position = file_object.tell()
+        self._size = os.fstat(file_object.fileno()).st_size
+        self._map = None
+        self._view = None
+        # set if the file can't be mapped, it is read instead
+        self._unmappable = False
+
+    @staticmethod
+    def supports(file_object):
+        """Check if ``file_object`` is a non-empty regular file."""
+        try:
+            st = os.fstat(file_object.fileno())
+        except (OSError, ValueError, io.UnsupportedOperation):
+            return False
+        return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+    @property
+    def len(self):
+        return max(self._size - self._position, 0)
+
+    def read(self, length=-1):
+        start = min(self._position, self._size)
+        if length is None or length < 0:
+            end = self._size
+        else:
+            end = min(start + length, self._size)
+        if start >= end:
+            self.close()
+            return memoryview(b'')
+        self._position = end
+        if not self._unmappable and self._view is None:
+            try:
+                self._map = mmap.mmap(self.fd.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+            except (OSError, ValueError, OverflowError):
+                # e.g. not enough address space on 32-bit systems
+                self._unmappable = True
+        if self._unmappable:
+            return memoryview(self._read_file(start, end - start))
+        return self._view[start:end]
+
+    def _read_file(self, offset, length):
+        position = self.fd.tell()
+        try:
+            self.fd.seek(offset)
+            return self.fd.read(length)
+        finally:
+            self.fd.seek(position)
+
+    def skip(self, length):
+        length = max(min(length, self.len), 0)
+        self._position += length
+        return length
+
+    def close(self):
+        """Unmap the file, ``file_object`` itself stays open.
+
+        Slices returned by :meth:`read` that are still referenced keep
+        the mapping alive until they are released.
+        """
+        if self._view is not None:
+            self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # exported slices, the map is closed once they are freed
+                pass
+        self._view = None
+        self._map = None
+
 
 class FileFromURLWrapper(object):
     """File from URL wrapper.
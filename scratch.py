@@ -0,0 +1,117 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+WORK_DIR_PREFIX = "sheepit-"
+
+# Holds the id of the process that created a work directory
+PID_FILE = "pid"
+
+# Work directories of processes that can't be checked are removed after
+# this many seconds
+STALE_AGE = 24 * 60 * 60
+
+# Required space is multiplied by this, Blender needs some room on top
+# of the files themselves
+SPACE_MARGIN = 1.2
+
+
+class WorkDirectory():
+    """ Directory for the intermediate files of one submission inside the
+        scratch directory root, removed as a whole by cleanup() """
+
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.path = tempfile.mkdtemp(prefix=WORK_DIR_PREFIX, dir=root)
+        with open(os.path.join(self.path, PID_FILE), "w") as f:
+            f.write(str(os.getpid()))
+
+    def file(self, *parts):
+        """ Returns the path of a file in the work directory, creating
+            its parent directories """
+        path = os.path.join(self.path, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def process_alive(pid):
+    """ Returns whether a process with pid is running, or None if this
+        can't be checked on this platform """
+    if sys.platform == "win32":
+        # os.kill() would terminate the process on Windows
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_stale_work_directories(root):
+    """ Removes the work directories in root left behind by processes
+        that crashed or were killed, returns their number """
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return 0
+    removed = 0
+    for name in names:
+        path = os.path.join(root, name)
+        if not name.startswith(WORK_DIR_PREFIX) or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, PID_FILE), "r") as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            pid = None
+        if pid == os.getpid():
+            continue
+        alive = process_alive(pid) if pid else None
+        if alive is None:
+            try:
+                alive = time.time() - os.path.getmtime(path) < STALE_AGE
+            except OSError:
+                continue
+        if not alive:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def check_free_space(directory, required):
+    """ Returns an error message if directory has less than required
+        bytes (times SPACE_MARGIN) free, or an empty string """
+    try:
+        free = shutil.disk_usage(directory).free
+    except OSError:
+        return ""
+    required = int(required * SPACE_MARGIN)
+    if free >= required:
+        return ""
+    return (f"Not enough space in {directory}: about "
+            f"{required / 1e9:.1f} GB are needed, {free / 1e9:.1f} GB "
+            "are free. Choose another scratch directory in the add-on "
+            "preferences.")
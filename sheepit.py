@@ -14,10 +14,31 @@
 
 import sys
 import os
+import json
+import hashlib
+import uuid
+import time
+import http.client
+import urllib.parse
 import requests.sessions
 import requests.cookies
 import html.parser
 from .requests_toolbelt.multipart import encoder
+from . import compression
+
+
+# Size of the blocks written to the socket while uploading a project
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Number of times a resumable upload is retried after a dropped connection
+UPLOAD_RETRIES = 5
+
+# Minimum number of bytes and seconds between two upload progress callbacks
+UPLOAD_PROGRESS_BYTES = 4 * 1024 * 1024
+UPLOAD_PROGRESS_INTERVAL = 0.25
+
+# Number of bytes handed to the kernel per sendfile() call
+SENDFILE_CHUNK_SIZE = 16 * 1024 * 1024
 
 
 class NetworkException(Exception):
@@ -36,9 +57,13 @@ class Sheepit():
     """ Api for Managing your SheepIt Account
         and uploading Project """
 
-    def __init__(self):
-        self.domain = "www.sheepit-renderfarm.com"
+    def __init__(self, domain="www.sheepit-renderfarm.com", scheme="https"):
+        self.domain = domain
+        self.url = f"{scheme}://{domain}"
         self.session = requests.session()
+        # whether the server continues uploads sent with Content-Range,
+        # None until an upload was resumed
+        self.accepts_ranges = None
 
     def __del__(self):
         self.session.close()
@@ -55,7 +80,7 @@ class Sheepit():
             NetworkError on a failed connection
             LoginError on a Wrong username and/or password """
         try:
-            r = self.session.post(f"https://{self.domain}/user/authenticate",
+            r = self.session.post(f"{self.url}/user/authenticate",
                                   data={"login": username,
                                         "password": password,
                                         "do_login": "do_login",
@@ -81,7 +106,7 @@ class Sheepit():
                 cookies will still be cleared """
         try:
             self.session.get(
-                f"https://{self.domain}/user/logout", timeout=5)
+                f"{self.url}/user/logout", timeout=5)
         except requests.exceptions.Timeout:
             raise NetworkException("Timed out")
         except requests.exceptions.RequestException:
@@ -102,7 +127,7 @@ class Sheepit():
         r = None
         try:
             r = self.session.get(
-                f"https://{self.domain}/user/{username}/profile", timeout=5)
+                f"{self.url}/user/{username}/profile", timeout=5)
         except requests.exceptions.Timeout:
             raise NetworkException("Timed out")
         except requests.exceptions.RequestException:
@@ -126,7 +151,7 @@ class Sheepit():
             UploadException if the maximum number of simultaneous
                 projects had been reached """
         try:
-            r = self.session.get(f"https://{self.domain}/getstarted",
+            r = self.session.get(f"{self.url}/getstarted",
                                  timeout=5)
         except requests.exceptions.Timeout:
             raise NetworkException("Timed out")
@@ -143,47 +168,400 @@ class Sheepit():
             )
         return p.token
 
-    def upload_file(self, token, path_to_file):
+    def upload_file(self, token, path_to_file, resumable=False,
+                    retries=UPLOAD_RETRIES, progress_callback=None):
         """ Uploads the selected file to the Server
 
-            Use get_upload_progress() to track the upload progress
-            and add_job() to add the uploaded project
+            If resumable is True, a dropped connection is retried up to
+            retries times. Each retry continues at the offset the server
+            confirmed with get_upload_status(). A resumed upload is only
+            accepted once the server reports that the whole form
+            arrived, otherwise the server ignores Content-Range: the
+            upload starts over from the first byte and later retries
+            on this session resend the whole form right away.
+
+            progress_callback(bytes_sent, total_bytes, bytes_per_second)
+            is called from the uploading thread while the file is sent,
+            at most every UPLOAD_PROGRESS_BYTES bytes or
+            UPLOAD_PROGRESS_INTERVAL seconds and once when done.
+            get_upload_progress() can still be used to ask the server
+            how much it received.
+
+            Returns the SHA-256 hex digest of the file, hashed while
+            it was sent. Resumed uploads don't send the whole file and
+            return None, as do uploads over plain http, where the file
+            is sent with sendfile() without passing through Python.
+
+            Use add_job() to add the uploaded project
+
+            Raises:
+            NetworkError on a failed connection """
+        post_upload = self._post_upload
+        if self.can_sendfile():
+            post_upload = self._sendfile_upload
+        if not resumable:
+            accepted, digest = post_upload(
+                token, path_to_file, uuid.uuid4().hex,
+                progress_callback=progress_callback)
+            return digest
+
+        # the body must be identical between attempts, so the boundary
+        # is kept
+        boundary = uuid.uuid4().hex
+        acknowledged = 0
+        attempt = 0
+        while True:
+            try:
+                accepted, digest = post_upload(
+                    token, path_to_file, boundary, acknowledged,
+                    progress_callback)
+            except NetworkException:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                resumed_at = acknowledged
+                acknowledged = 0
+                if self.accepts_ranges is not False:
+                    acknowledged = self._confirmed_offset(
+                        token, path_to_file, boundary)
+                if resumed_at and acknowledged <= resumed_at:
+                    # the resumed bytes didn't count towards the upload
+                    self.accepts_ranges = False
+                    acknowledged = 0
+                continue
+            if accepted:
+                if acknowledged:
+                    self.accepts_ranges = True
+                return digest
+            # the server didn't take the rest of the form, start over
+            self.accepts_ranges = False
+            acknowledged = 0
+
+    def upload_archive(self, token, archive, filename,
+                       progress_callback=None):
+        """ Uploads an archive.ZipStream as project file, the archive is
+            generated while it is sent
+
+            Archives whose deflated members weren't measured have no
+            known length, they are sent with chunked transfer encoding.
+            progress_callback is called like in upload_file(), for those
+            with the number of member bytes that were read.
+
+            Returns the SHA-256 hex digest of the archive
+
+            Raises:
+            NetworkError on a failed connection
+            OSError if a member of the archive can't be read """
+        if archive.scan() is None:
+            digest = hashlib.sha256()
+
+            def blocks():
+                for block in archive:
+                    digest.update(block)
+                    yield block
+
+            self._post_chunked(
+                token, filename, blocks(),
+                lambda: (archive.bytes_read, archive.data_size),
+                progress_callback)
+            return digest.hexdigest()
+        form = encoder.MultipartEncoder({
+            "UPLOAD_IDENTIFIER": token,
+            "addjob_archive": (filename, archive, "multipart/form-data")
+        }, block_size=UPLOAD_BLOCK_SIZE, hash_name="sha256")
+        headers = {"Prefer": "respond-async",
+                   "Content-Type": form.content_type}
+        monitor = encoder.MultipartEncoderMonitor(
+            form, self._progress_forwarder(progress_callback),
+            min_bytes=UPLOAD_PROGRESS_BYTES,
+            min_interval=UPLOAD_PROGRESS_INTERVAL)
+        try:
+            self.session.post(f"{self.url}/project/internal/upload",
+                              data=encoder.BlockIterator(monitor),
+                              headers=headers)
+        except requests.exceptions.RequestException:
+            raise NetworkException("Failed connecting to the sheepit server")
+        return form.digests["addjob_archive"]
+
+    def upload_file_compressed(self, token, path_to_file,
+                               progress_callback=None):
+        """ Compresses the uncompressed blend file at path_to_file with
+            gzip while it is uploaded, see compression.CompressionPipeline
+
+            The size of the upload isn't known in advance, so it is sent
+            with chunked transfer encoding and can't be resumed.
+            progress_callback is called like in upload_file(), with the
+            number of uncompressed bytes that were read.
+
+            Returns the SHA-256 hex digest of the uncompressed file and
+            the stage timings of the pipeline
+
+            Raises:
+            NetworkError on a failed connection """
+        pipeline = compression.CompressionPipeline(path_to_file)
+        try:
+            self._post_chunked(
+                token, os.path.split(path_to_file)[1], pipeline,
+                lambda: (pipeline.bytes_read, pipeline.size),
+                progress_callback)
+        finally:
+            pipeline.close()
+        return pipeline.digest, pipeline.stats
+
+    def _post_chunked(self, token, filename, blocks, progress,
+                      progress_callback=None):
+        """ Posts the upload form with the iterable blocks as file, with
+            chunked transfer encoding since its size isn't known in
+            advance. progress returns the bytes processed and the bytes
+            to process for progress_callback.
+
+            Raises:
+            NetworkError on a failed connection """
+        boundary = uuid.uuid4().hex
+        filename = filename.replace('"', "%22")
+        preamble = (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="UPLOAD_IDENTIFIER"\r\n'
+            "\r\n"
+            f"{token}\r\n"
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="addjob_archive"; '
+            f'filename="{filename}"\r\n'
+            "Content-Type: multipart/form-data\r\n"
+            "\r\n").encode("utf-8")
+        epilogue = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+        def body():
+            yield preamble
+            start = last_call = time.monotonic()
+            for block in blocks:
+                yield block
+                now = time.monotonic()
+                if progress_callback and \
+                        now - last_call >= UPLOAD_PROGRESS_INTERVAL:
+                    last_call = now
+                    done, total = progress()
+                    progress_callback(done, total, done / (now - start))
+            if progress_callback:
+                total = progress()[1]
+                progress_callback(total, total, 0)
+            yield epilogue
+
+        headers = {"Prefer": "respond-async",
+                   "Content-Type":
+                   f"multipart/form-data; boundary={boundary}"}
+        try:
+            self.session.post(f"{self.url}/project/internal/upload",
+                              data=body(), headers=headers)
+        except requests.exceptions.RequestException:
+            raise NetworkException("Failed connecting to the sheepit server")
+
+    def _post_upload(self, token, path_to_file, boundary, offset=0,
+                     progress_callback=None):
+        """ Posts the upload form, starting offset bytes into its body
+
+            Returns False if the server rejected a resumed upload, and
+            the SHA-256 hex digest of the file if it was sent completely
 
             Raises:
             NetworkError on a failed connection """
         with open(path_to_file, "rb") as f:
+            form = encoder.MultipartEncoder({
+                "UPLOAD_IDENTIFIER": token,
+                "addjob_archive": (os.path.split(path_to_file)[1], f, "multipart/form-data")
+            }, boundary=boundary, block_size=UPLOAD_BLOCK_SIZE,
+                hash_name="sha256")
             try:
-                form = encoder.MultipartEncoder({
-                    "UPLOAD_IDENTIFIER": token,
-                    "addjob_archive": (os.path.split(path_to_file)[1], f, "multipart/form-data")
-                })
                 headers = {"Prefer": "respond-async",
                            "Content-Type": form.content_type}
+                length = form.len
+                if offset:
+                    if offset >= length:
+                        # everything already arrived
+                        return True, None
+                    form.skip(offset)
+                    headers["Content-Range"] = \
+                        f"bytes {offset}-{length - 1}/{length}"
+                monitor = encoder.MultipartEncoderMonitor(
+                    form, self._progress_forwarder(progress_callback),
+                    min_bytes=UPLOAD_PROGRESS_BYTES,
+                    min_interval=UPLOAD_PROGRESS_INTERVAL)
+                monitor.bytes_read = offset
+                body = encoder.BlockIterator(monitor)
+                body.len = length - offset
+                # send large blocks instead of httplib's 8 KiB reads
                 r = self.session.post(
-                    f"https://{self.domain}/project/internal/upload", data=form, headers=headers)
+                    f"{self.url}/project/internal/upload",
+                    data=body, headers=headers)
             except requests.exceptions.RequestException as e:
                 raise NetworkException(
                     "Failed connecting to the sheepit server")
+            finally:
+                # unmap the file before it is closed, a mapping would
+                # keep it from being deleted on Windows
+                form.close()
+        accepted = not offset or \
+            (r.ok and self._upload_complete(token, length))
+        return accepted, form.digests["addjob_archive"]
+
+    def can_sendfile(self):
+        """ Returns True if uploads can use the sendfile() fast path
+
+            This needs a plain http connection (TLS encrypts in user
+            space) and a platform with os.sendfile() """
+        return self.url.startswith("http://") and hasattr(os, "sendfile")
+
+    def _sendfile_upload(self, token, path_to_file, boundary, offset=0,
+                         progress_callback=None):
+        """ Posts the same body as _post_upload(), but lets the kernel
+            copy the file to the socket with sendfile()
+
+            The form is written with http.client, the session is only
+            used for its headers and cookies. Returns the same as
+            _post_upload(), without a digest.
 
-    def get_upload_progress(self, token):
-        """ Returns the upload progress in percent
+            Raises:
+            NetworkError on a failed connection """
+        url = f"{self.url}/project/internal/upload"
+        with open(path_to_file, "rb") as f:
+            form = encoder.MultipartEncoder({
+                "UPLOAD_IDENTIFIER": token,
+                "addjob_archive": (os.path.split(path_to_file)[1], f, "multipart/form-data")
+            }, boundary=boundary)
+            length = form.len
+            size = os.fstat(f.fileno()).st_size
+            tail = f"\r\n{form.boundary}--\r\n".encode(form.encoding)
+            head = bytes(form.read(length - size - len(tail)))
+            if offset >= length:
+                # everything already arrived
+                return True, None
+            headers = {"Prefer": "respond-async",
+                       "Content-Type": form.content_type,
+                       "Content-Length": str(length - offset)}
+            if offset:
+                headers["Content-Range"] = \
+                    f"bytes {offset}-{length - 1}/{length}"
+            request = self.session.prepare_request(
+                requests.Request("POST", url, headers=headers))
+            parsed = urllib.parse.urlsplit(url)
+            connection = http.client.HTTPConnection(parsed.hostname,
+                                                    parsed.port)
+            try:
+                connection.putrequest("POST", parsed.path,
+                                      skip_accept_encoding=True)
+                for name, value in request.headers.items():
+                    connection.putheader(name, value)
+                connection.endheaders()
+
+                # offsets of the file inside the body
+                file_start = len(head)
+                file_end = file_start + size
+                position = offset
+                start_time = last_call = time.monotonic()
+                if position < file_start:
+                    connection.sock.sendall(head[position:])
+                    position = file_start
+                while position < file_end:
+                    count = min(SENDFILE_CHUNK_SIZE, file_end - position)
+                    position += connection.sock.sendfile(
+                        f, position - file_start, count)
+                    now = time.monotonic()
+                    if progress_callback and \
+                            now - last_call >= UPLOAD_PROGRESS_INTERVAL:
+                        last_call = now
+                        progress_callback(
+                            position, length,
+                            (position - offset) / (now - start_time))
+                connection.sock.sendall(tail[position - file_end:])
+                if progress_callback:
+                    progress_callback(length, length, 0)
+                r = connection.getresponse()
+                r.read()
+            except (OSError, http.client.HTTPException):
+                raise NetworkException(
+                    "Failed connecting to the sheepit server")
+            finally:
+                connection.close()
+        accepted = not offset or \
+            (200 <= r.status < 300 and self._upload_complete(token, length))
+        return accepted, None
+
+    @staticmethod
+    def _progress_forwarder(progress_callback):
+        """ Adapts progress_callback to a MultipartEncoderMonitor callback """
+        if not progress_callback:
+            return None
+
+        def forward(monitor):
+            progress_callback(monitor.bytes_read, monitor.len,
+                              monitor.throughput)
+        return forward
+
+    def _confirmed_offset(self, token, path_to_file, boundary):
+        """ Returns how many bytes of the upload form the server has
+            received, or 0 if the upload can't be resumed """
+        try:
+            status = self.get_upload_status(token)
+        except NetworkException:
+            return 0
+        if not status:
+            return 0
+        with open(path_to_file, "rb") as f:
+            length = encoder.MultipartEncoder({
+                "UPLOAD_IDENTIFIER": token,
+                "addjob_archive": (os.path.split(path_to_file)[1], f, "multipart/form-data")
+            }, boundary=boundary).len
+        if status["content_length"] != length:
+            return 0
+        return min(status["bytes_processed"], length)
+
+    def _upload_complete(self, token, length):
+        """ Returns True if the server reports that all length bytes of
+            the upload form arrived
+
+            A server that ignores Content-Range answers a resumed upload
+            like a new one, so its reply alone doesn't tell whether the
+            upload is complete """
+        try:
+            status = self.get_upload_status(token)
+        except NetworkException:
+            return False
+        return bool(status) and status["content_length"] == length and \
+            status["bytes_processed"] == length
+
+    def get_upload_status(self, token):
+        """ Returns a dict with the number of bytes the server received
+            ("bytes_processed") and the size of the upload
+            ("content_length"), or None if the server has no
+            upload with this token
 
             Raises:
             NetworkError on a failed connection """
         try:
             r = self.session.post(
-                f"https://{self.domain}/project/internal/progress", data={
+                f"{self.url}/project/internal/progress", data={
                     "uid": token
                 },
                 timeout=5
             )
             dict = eval(r.content)
-            return int(dict['bytes_processed'])/int(dict['content_length'])
+            return {"bytes_processed": int(dict['bytes_processed']),
+                    "content_length": int(dict['content_length'])}
         except requests.exceptions.RequestException:
             raise NetworkException("Failed connecting to the sheepit server")
-        except SyntaxError:
+        except (SyntaxError, TypeError, KeyError, ValueError):
             return
 
+    def get_upload_progress(self, token):
+        """ Returns the upload progress in percent
+
+            Raises:
+            NetworkError on a failed connection """
+        status = self.get_upload_status(token)
+        if not status or not status["content_length"]:
+            return
+        return status["bytes_processed"]/status["content_length"]
+
     def add_job(self, token, animation=True, cpu=True, cuda=False,
                 opencl=False, public=True, mp4=False,
                 anim_start_frame=None, anim_end_frame=None,
@@ -215,7 +593,7 @@ class Sheepit():
 
         try:
             r = self.session.get(
-                f"https://{self.domain}/project/add")
+                f"{self.url}/project/add")
         except requests.exceptions.RequestException:
             raise NetworkException("Failed connecting to the sheepit server")
         parser = AddJobParser()
@@ -261,7 +639,7 @@ class Sheepit():
             settings["split_samples"] = param_split_layers
         try:
             r = self.session.post(
-                f"https://{self.domain}/project/add_internal", data=settings)
+                f"{self.url}/project/add_internal", data=settings)
         except requests.exceptions.RequestException:
             raise NetworkException("Failed connecting to the sheepit server")
 
@@ -297,13 +675,61 @@ class Sheepit():
             return False
         try:
             r = self.session.get(
-                f"https://{self.domain}/account.php?mode=login", timeout=5)
+                f"{self.url}/account.php?mode=login", timeout=5)
             # return True if redirected to main page
-            return r.url == f"https://{self.domain}/"
+            return r.url == f"{self.url}/"
         except requests.exceptions.RequestException:
             raise NetworkException("Failed connecting to the sheepit server")
 
 
+class UploadIndex():
+    """ Records the SHA-256 digests of recent uploads in a JSON file,
+        so uploading an identical project again can be detected """
+
+    def __init__(self, path, max_entries=100):
+        self.path = path
+        self.max_entries = max_entries
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def lookup(self, digest):
+        """ Returns a dict with "size", "token" and "uploaded" (a unix
+            timestamp) of the last upload with this digest, or None """
+        return self.load().get(digest)
+
+    def add(self, digest, size, token):
+        entries = self.load()
+        entries.pop(digest, None)
+        entries[digest] = {"size": size,
+                           "token": token,
+                           "uploaded": time.time()}
+        # dicts keep their insertion order, drop the oldest entries
+        for old in list(entries)[:-self.max_entries]:
+            del entries[old]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+def file_fingerprint(path, sample_size=1024 * 1024):
+    """ Returns a cheap fingerprint of a file: its size, modification time
+        and a hash of its first and last sample_size bytes """
+    st = os.stat(path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        h.update(f.read(sample_size))
+        if st.st_size > sample_size:
+            f.seek(max(st.st_size - sample_size, sample_size))
+            h.update(f.read(sample_size))
+    return f"{st.st_size}-{st.st_mtime_ns}-{h.hexdigest()}"
+
+
 class ProfileParser(html.parser.HTMLParser):
     """ Parses the account.php?mode=profile Page """
 
@@ -0,0 +1,133 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import csv
+import json
+import zlib
+from . import blendfile
+from .compression import GZIP_LEVEL
+
+
+# Categories of the report by datablock code, others are grouped as
+# "Other"
+CATEGORIES = {
+    "IM": "Images",
+    "ME": "Meshes",
+    "CF": "Caches",
+    "LI": "Libraries",
+    "VO": "Volumes",
+    "SO": "Sounds",
+    "VF": "Fonts",
+    "MA": "Materials",
+    "NT": "Node Groups",
+    "OB": "Objects",
+    "PT": "Point Clouds",
+    "CV": "Curves",
+    "CU": "Curves",
+    "GD": "Grease Pencil",
+    "AC": "Actions",
+}
+
+# Datablocks up to this size are compressed whole to estimate their
+# compressed size, larger ones are sampled
+SAMPLE_SIZE = 1024 * 1024
+
+# Number of evenly spaced samples taken from large datablocks
+SAMPLE_COUNT = 4
+
+
+def compressed_size(data):
+    """ Estimates the size of data compressed the way uploads of
+        uncompressed files are """
+    if len(data) <= SAMPLE_SIZE:
+        return len(zlib.compress(data, GZIP_LEVEL))
+    sample_size = SAMPLE_SIZE // SAMPLE_COUNT
+    step = (len(data) - sample_size) // (SAMPLE_COUNT - 1)
+    compressed = sum(
+        len(zlib.compress(data[i * step:i * step + sample_size],
+                          GZIP_LEVEL))
+        for i in range(SAMPLE_COUNT))
+    return int(compressed / (sample_size * SAMPLE_COUNT) * len(data))
+
+
+def size_report(path):
+    """ Returns the datablocks of the blend file at path, largest first,
+        as dicts with "category", "code", "name", "bytes" (uncompressed)
+        and "compressed_bytes"
+
+        Compressed files are read in one pass and decompressed in
+        memory, compressed_bytes is the part of the file the datablock
+        takes with the file's own codec. Uncompressed files are gzipped
+        while uploading, their compressed_bytes are estimated with the
+        same level.
+
+        Raises:
+        blendfile.BlendFileError if the file can't be read """
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(4)
+    except OSError as e:
+        raise blendfile.BlendFileError(f"Could not read {path}: {e}")
+    if magic.startswith(blendfile.GZIP_MAGIC) or \
+            magic == blendfile.ZSTD_MAGIC:
+        datablocks = blendfile.stream_datablocks(path)
+    else:
+        datablocks = []
+        with blendfile.BlendFile(path) as blend:
+            for datablock in blend.datablocks():
+                # headers are part of the range, size only counts the data
+                with blend.view(datablock.block.offset,
+                                datablock.end) as data:
+                    datablocks.append((datablock, compressed_size(data)))
+    entries = [{
+        "category": CATEGORIES.get(datablock.code, "Other"),
+        "code": datablock.code,
+        "name": datablock.name,
+        "bytes": datablock.size,
+        "compressed_bytes": compressed,
+    } for datablock, compressed in datablocks]
+    entries.sort(key=lambda e: e["bytes"], reverse=True)
+    return entries
+
+
+def category_totals(entries):
+    """ Returns a list of dicts with "category", "count", "bytes" and
+        "compressed_bytes" for every category, largest first """
+    totals = dict()
+    for entry in entries:
+        total = totals.setdefault(entry["category"], {
+            "category": entry["category"],
+            "count": 0,
+            "bytes": 0,
+            "compressed_bytes": 0,
+        })
+        total["count"] += 1
+        total["bytes"] += entry["bytes"]
+        total["compressed_bytes"] += entry["compressed_bytes"]
+    return sorted(totals.values(), key=lambda t: t["bytes"], reverse=True)
+
+
+def export(entries, path):
+    """ Writes the report as CSV if path ends with .csv, otherwise as
+        JSON with the category totals """
+    if path.lower().endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[
+                "category", "code", "name", "bytes", "compressed_bytes"])
+            writer.writeheader()
+            writer.writerows(entries)
+    else:
+        with open(path, "w") as f:
+            json.dump({"categories": category_totals(entries),
+                       "datablocks": entries}, f, indent=1)
@@ -0,0 +1,243 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Local stand-in for the upload endpoints of the SheepIt server, to test
+# uploads over connections that drop mid-stream. Runs with any Python 3,
+# without Blender:
+#
+#   python tools/upload_test_server.py --port 8000 --drop 2
+#
+# and point the client at it:
+#
+#   session = sheepit.Sheepit(domain="localhost:8000", scheme="http")
+#   session.upload_file("token", path, resumable=True)
+#
+# /project/internal/upload kills the connection of the first --drop
+# uploads halfway through their body. Like the PHP upload progress the
+# real server uses, /project/internal/progress reports the bytes received
+# for an UPLOAD_IDENTIFIER, taken from the start of the body. Content-Range
+# is ignored (like on the real server) unless --ranges is given, then
+# resumed bodies are appended to the upload they continue. Bodies sent
+# with chunked transfer encoding (compressed uploads and archives) are
+# accepted but never dropped, they can't be resumed. Every complete form
+# is written to --output and the SHA-256 of its file part is printed, to
+# compare with the uploaded file.
+
+
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import socket
+import threading
+
+
+# Size of the blocks read from the request body
+READ_BLOCK_SIZE = 1024 * 1024
+
+UPLOAD_IDENTIFIER = re.compile(
+    rb'name="UPLOAD_IDENTIFIER"\r\n\r\n([^\r]*)\r\n')
+
+
+class Upload():
+    """ A form received by the server, possibly in several requests """
+
+    def __init__(self, path, length):
+        self.path = path
+        self.length = length
+        self.received = 0
+        self.uid = None
+
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.path == "/project/internal/upload":
+            self.upload()
+        elif self.path == "/project/internal/progress":
+            self.progress()
+        else:
+            self.respond(404, b"")
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def progress(self):
+        length = int(self.headers.get("Content-Length", 0))
+        fields = dict(field.split("=", 1) for field in
+                      self.rfile.read(length).decode().split("&") if field)
+        upload = self.server.by_uid.get(fields.get("uid"))
+        if upload is None:
+            self.respond(200, b"")
+            return
+        self.respond(200, repr({"bytes_processed": upload.received,
+                                "content_length": upload.length}).encode())
+
+    def upload(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self.upload_chunked()
+            return
+        length = int(self.headers["Content-Length"])
+        content_range = self.headers.get("Content-Range")
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            drop = server.requests <= server.drop
+        if content_range and server.ranges:
+            match = re.match(r"bytes (\d+)-(\d+)/(\d+)", content_range)
+            start, total = int(match.group(1)), int(match.group(3))
+            upload = server.last
+            if upload is None or upload.received != start or \
+                    upload.length != total:
+                self.rfile.read(length)
+                self.respond(416, b"")
+                return
+        else:
+            # a new form, on a server without range support also the
+            # rest of a form sent with Content-Range
+            content_range = None
+            upload = server.last = Upload(
+                os.path.join(server.output,
+                             f"upload-{server.requests}.body"), length)
+        drop_at = upload.received + length // 2 if drop else None
+        with open(upload.path, "ab" if content_range else "wb") as f:
+            remaining = length
+            while remaining:
+                block = self.rfile.read(min(READ_BLOCK_SIZE, remaining))
+                if not block:
+                    return
+                if drop_at is not None and \
+                        upload.received + len(block) >= drop_at:
+                    block = block[:drop_at - upload.received]
+                f.write(block)
+                f.flush()
+                remaining -= len(block)
+                upload.received += len(block)
+                if not content_range and remaining + len(block) == length:
+                    # the first block of a new form
+                    self.register(upload)
+                if drop_at is not None and upload.received >= drop_at:
+                    print(f"dropped upload {server.requests} after "
+                          f"{upload.received} of {upload.length} bytes")
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+        if upload.received == upload.length:
+            print(f"received {upload.path}: {check_form(upload.path)}")
+        self.respond(200, b"")
+
+    def upload_chunked(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        upload = server.last = Upload(
+            os.path.join(server.output, f"upload-{server.requests}.body"),
+            None)
+        with open(upload.path, "wb") as f:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                size = int(line.split(b";")[0], 16)
+                if size == 0:
+                    # trailer headers, up to an empty line
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                remaining = size
+                while remaining:
+                    block = self.rfile.read(min(READ_BLOCK_SIZE, remaining))
+                    if not block:
+                        return
+                    f.write(block)
+                    remaining -= len(block)
+                    upload.received += len(block)
+                self.rfile.readline()
+                if upload.uid is None:
+                    f.flush()
+                    self.register(upload)
+        upload.length = upload.received
+        print(f"received {upload.path} (chunked): "
+              f"{check_form(upload.path)}")
+        self.respond(200, b"")
+
+    def register(self, upload):
+        with open(upload.path, "rb") as f:
+            match = UPLOAD_IDENTIFIER.search(f.read(64 * 1024))
+        if match:
+            upload.uid = match.group(1).decode()
+            self.server.by_uid[upload.uid] = upload
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check_form(path):
+    """ Returns the SHA-256 of the file part of a multipart form, or why
+        the form is broken """
+    with open(path, "rb") as f:
+        first_line = f.readline()
+        if not first_line.startswith(b"--"):
+            return "form doesn't start with a boundary"
+        boundary = first_line.rstrip(b"\r\n")
+        head = f.read(64 * 1024)
+        marker = head.find(b'name="addjob_archive"')
+        if marker < 0:
+            return "form has no file part"
+        start = len(first_line) + head.index(b"\r\n\r\n", marker) + 4
+        tail = b"\r\n" + boundary + b"--\r\n"
+        end = os.path.getsize(path) - len(tail)
+        f.seek(end)
+        if f.read() != tail:
+            return "form isn't closed by its boundary"
+        f.seek(start)
+        digest = hashlib.sha256()
+        remaining = end - start
+        while remaining:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            digest.update(block)
+            remaining -= len(block)
+    return f"file part SHA-256 {digest.hexdigest()}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--drop", type=int, default=1,
+                        help="number of uploads killed halfway")
+    parser.add_argument("--ranges", action="store_true",
+                        help="append bodies sent with Content-Range")
+    parser.add_argument("--output", default=".",
+                        help="directory the received forms are written to")
+    options = parser.parse_args()
+    os.makedirs(options.output, exist_ok=True)
+    server = http.server.ThreadingHTTPServer(("localhost", options.port),
+                                             UploadHandler)
+    server.drop = options.drop
+    server.ranges = options.ranges
+    server.output = options.output
+    server.requests = 0
+    server.last = None
+    server.by_uid = dict()
+    server.lock = threading.Lock()
+    print(f"listening on http://localhost:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# This module is imported by prepare_scene.py inside a separate Blender
+# process and runs as a script in a plain Python process it starts, so it
+# must not import bpy.
+
+
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    # shipped with Blender's Python since Blender 4.0
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+
+# Formats that are stored without (or with weak) compression
+LOSSLESS_EXTENSIONS = {".tif", ".tiff", ".exr", ".bmp", ".tga"}
+
+# Written next to the results, so a changed encoder invalidates them
+TRANSCODE_VERSION = 1
+
+# Prefix of the result lines written by main()
+RESULT_PREFIX = "SHEEPIT-TRANSCODE "
+
+
+def available():
+    return oiio is not None
+
+
+def parse_rules(rules):
+    """ Parses "pattern=size" rules into (pattern, size) tuples """
+    parsed = []
+    for rule in rules:
+        pattern, _, size = rule.rpartition("=")
+        if not pattern:
+            raise ValueError(f"Invalid texture rule: {rule}")
+        parsed.append((pattern, int(size)))
+    return parsed
+
+
+def max_size_for(path, rules, default=0):
+    """ Returns the maximum resolution of the image at path, the size of
+        the first rule whose pattern matches its path or file name,
+        0 means no limit """
+    for pattern, size in rules:
+        if fnmatch.fnmatch(path, pattern) or \
+                fnmatch.fnmatch(os.path.basename(path), pattern):
+            return size
+    return default
+
+
+def file_digest(path, block_size=1024 * 1024):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def transcode(path, cache_dir, max_size=0, digest=None):
+    """ Recompresses and downscales the image at path into cache_dir
+
+        Lossless formats are written as compressed PNG, or as EXR with
+        ZIP compression if they hold float data, and are downscaled so
+        neither side exceeds max_size. Results are named after the
+        SHA-256 of the source, so an unchanged source is only transcoded
+        once. digest is the source's digest if it is already known, so
+        a cached result is found without reading the source.
+
+        Returns a dict with the path of the file to use, its size, the
+        size of the source and whether it came from the cache """
+    start = time.perf_counter()
+    source_size = os.path.getsize(path)
+    result = {"source": path, "path": path, "bytes_in": source_size,
+              "bytes_out": source_size, "cached": False, "seconds": 0.0}
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in LOSSLESS_EXTENSIONS and not max_size:
+        return result
+
+    buf = oiio.ImageBuf(path)
+    spec = buf.spec()
+    if buf.has_error:
+        raise OSError(buf.geterror())
+    is_float = spec.format.basetype in {oiio.FLOAT, oiio.HALF, oiio.DOUBLE}
+    output_extension = ".exr" if is_float else ".png"
+    scale = 1.0
+    if max_size and max(spec.width, spec.height) > max_size:
+        scale = max_size / max(spec.width, spec.height)
+    if scale == 1.0 and extension not in LOSSLESS_EXTENSIONS:
+        # small enough already, only the header was read
+        return result
+    digest = digest or file_digest(path)
+    name = f"{digest}-{max_size}-v{TRANSCODE_VERSION}{output_extension}"
+    output = os.path.join(cache_dir, name)
+
+    if os.path.isfile(output):
+        result["cached"] = True
+    else:
+        if scale != 1.0:
+            roi = oiio.ROI(0, max(1, round(spec.width * scale)),
+                           0, max(1, round(spec.height * scale)),
+                           0, 1, 0, spec.nchannels)
+            buf = oiio.ImageBufAlgo.resize(buf, roi=roi)
+        if is_float:
+            buf.specmod().attribute("compression", "zip")
+        else:
+            buf.specmod().attribute("png:compressionLevel", 9)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_output = f"{output}.tmp{output_extension}"
+        if not buf.write(tmp_output):
+            raise OSError(buf.geterror())
+        os.replace(tmp_output, output)
+
+    output_size = os.path.getsize(output)
+    if output_size < source_size or max_size:
+        result["path"] = output
+        result["bytes_out"] = output_size
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def transcode_all(paths, cache_dir, rules=(), max_size=0, processes=None,
+                  callback=None, digests=None):
+    """ Transcodes paths in a process pool, see transcode(), digests maps
+        paths to the known digests of their files
+
+        The pool's processes import the __main__ module of this process,
+        so this must not be called from a process whose __main__ imports
+        bpy, use run_transcoder() there.
+
+        callback is called with the number of finished images and the
+        result after every image. Returns a dict mapping every source
+        path to its result, images that failed are left out
+
+        Raises:
+        BrokenProcessPool if the pool's processes died """
+    results = dict()
+    # fork isn't safe in a threaded Blender process
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=context) as executor:
+        futures = {
+            executor.submit(transcode, path, cache_dir,
+                            max_size_for(path, rules, max_size),
+                            (digests or {}).get(path)): path
+            for path in set(paths)
+        }
+        for done, future in enumerate(
+                concurrent.futures.as_completed(futures), 1):
+            try:
+                results[futures[future]] = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                print(f"Could not transcode {futures[future]}: {e}",
+                      file=sys.stderr)
+                continue
+            if callback:
+                callback(done, results[futures[future]])
+    return results
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def run_transcoder(paths, cache_dir, rules=(), max_size=0, callback=None,
+                   digests=None, executable=None):
+    """ Runs transcode_all() in a new Python process started with this
+        file as its __main__, so its pool doesn't import the caller's
+        __main__ (prepare_scene.py, which imports bpy)
+
+        executable is the Python interpreter, Blender's own by default.
+        Takes the arguments and returns the same as transcode_all().
+
+        Raises:
+        TranscodeError if the process or its pool failed """
+    job = {"paths": sorted(set(paths)), "cache_dir": cache_dir,
+           "rules": list(rules), "max_size": max_size,
+           "digests": digests or {}}
+    try:
+        process = subprocess.Popen(
+            [executable or sys.executable, os.path.abspath(__file__)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            encoding="utf-8", errors="replace")
+    except OSError as e:
+        raise TranscodeError(
+            f"Could not start the texture transcoder: {e}")
+    try:
+        process.stdin.write(json.dumps(job))
+        process.stdin.close()
+    except BrokenPipeError:
+        # exited right away, reported by its exit code below
+        pass
+    results = dict()
+    for line in process.stdout:
+        if not line.startswith(RESULT_PREFIX):
+            print(line, end="")
+            continue
+        result = json.loads(line[len(RESULT_PREFIX):])
+        results[result["source"]] = result
+        if callback:
+            callback(len(results), result)
+    if process.wait() != 0:
+        raise TranscodeError(
+            f"The texture transcoder failed with exit code "
+            f"{process.returncode}")
+    return results
+
+
+def main():
+    """ Reads a job from stdin and writes a line with RESULT_PREFIX and
+        the JSON result of every transcoded image, see run_transcoder() """
+    job = json.load(sys.stdin)
+
+    def report(done, result):
+        sys.stdout.write(RESULT_PREFIX + json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+    try:
+        transcode_all(job["paths"], job["cache_dir"],
+                      rules=[tuple(rule) for rule in job["rules"]],
+                      max_size=job["max_size"], callback=report,
+                      digests=job["digests"])
+    except BrokenProcessPool as e:
+        print(f"Transcoding processes died: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import concurrent.futures
+import json
+import queue
+import subprocess
+import threading
+
+
+# Must match prepare_scene.RESULT_PREFIX, prepare_scene.py can only be
+# imported inside Blender
+RESULT_PREFIX = "SHEEPIT-RESULT "
+
+# Must match prepare_scene.PROGRESS_PREFIX
+PROGRESS_PREFIX = "SHEEPIT-PROGRESS "
+
+# A worker is replaced after this many jobs...
+MAX_JOBS = 10
+
+# ...or once its peak memory use exceeds this many bytes
+MAX_MEMORY = 8 * 1024 * 1024 * 1024
+
+
+class WorkerError(Exception):
+    pass
+
+
+def parse_progress(line):
+    """ Returns the progress event written by prepare_scene.progress()
+        on line, or None if it is any other output """
+    if not line.startswith(PROGRESS_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(PROGRESS_PREFIX):])
+    except ValueError:
+        return None
+
+
+class PrepareWorker():
+    """ A background Blender process running the prepare_scene.py job
+        loop, jobs are sent as JSON lines over its stdin """
+
+    def __init__(self, blender_exe, prepare_script):
+        self.jobs = 0
+        self.peak_memory = 0
+        self.process = subprocess.Popen(
+            [
+                blender_exe,
+                "--background",
+                "--factory-startup",
+                "--python",
+                prepare_script,
+                "--",
+                "--worker"
+            ],
+            # Blender prints UTF-8 whatever the locale, jobs and results
+            # are ASCII JSON
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            encoding="utf-8", errors="replace", bufsize=1, shell=False
+        )
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run(self, source, output, args=(), progress_callback=None):
+        """ Prepares source into output with the prepare_scene.py options
+            args, returns the result dict of prepare_scene.prepare()
+
+            progress_callback is called with every progress event, the
+            rest of Blender's output is printed like for a Blender
+            started for one submission
+
+            Raises:
+            WorkerError if the worker died """
+        job = {"source": source, "output": output, "args": list(args)}
+        try:
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+            for line in self.process.stdout:
+                if line.startswith(RESULT_PREFIX):
+                    result = json.loads(line[len(RESULT_PREFIX):])
+                    break
+                event = parse_progress(line)
+                if not event:
+                    print(line, end="")
+                elif progress_callback:
+                    progress_callback(event)
+            else:
+                raise WorkerError("Blender worker exited")
+        except (OSError, ValueError):
+            raise WorkerError("Blender worker exited")
+        self.jobs += 1
+        self.peak_memory = result.get("peak_memory") or 0
+        return result
+
+    def stop(self):
+        """ Lets the worker finish its job loop """
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class PrepareWorkerPool():
+    """ Keeps up to size Blender workers running, so queued submissions
+        don't pay Blender's startup time
+
+        Workers are started on demand and replaced after max_jobs jobs or
+        once they used more than max_memory bytes. """
+
+    def __init__(self, blender_exe, prepare_script, size=1,
+                 max_jobs=MAX_JOBS, max_memory=MAX_MEMORY):
+        self.blender_exe = blender_exe
+        self.prepare_script = prepare_script
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self._idle = queue.LifoQueue()
+        # job state of every queued or running future
+        self._jobs = dict()
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(size)
+
+    def submit(self, source, output, args=(), progress_callback=None):
+        """ Queues a job, returns a concurrent.futures.Future with the
+            result of PrepareWorker.run() """
+        job = {"worker": None, "cancelled": False}
+        with self._lock:
+            future = self._executor.submit(self._run, source, output,
+                                           args, progress_callback, job)
+            self._jobs[future] = job
+        future.add_done_callback(self._forget)
+        return future
+
+    def cancel(self, future):
+        """ Cancels a queued job, or kills the worker running it """
+        if future.cancel():
+            return
+        with self._lock:
+            job = self._jobs.get(future)
+            if job:
+                job["cancelled"] = True
+                if job["worker"]:
+                    job["worker"].kill()
+
+    def _forget(self, future):
+        with self._lock:
+            self._jobs.pop(future, None)
+
+    def _run(self, source, output, args, progress_callback, job):
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            worker = None
+        if worker is None or not worker.is_alive():
+            worker = PrepareWorker(self.blender_exe, self.prepare_script)
+        with self._lock:
+            if job["cancelled"]:
+                self._idle.put(worker)
+                raise concurrent.futures.CancelledError()
+            job["worker"] = worker
+        try:
+            result = worker.run(source, output, args, progress_callback)
+        except WorkerError:
+            worker.kill()
+            raise
+        finally:
+            with self._lock:
+                job["worker"] = None
+        if worker.jobs >= self.max_jobs or \
+                worker.peak_memory > self.max_memory:
+            worker.stop()
+        else:
+            self._idle.put(worker)
+        return result
+
+    def shutdown(self):
+        """ Stops all workers, running jobs are killed """
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            for future, job in self._jobs.items():
+                future.cancel()
+                if job["worker"]:
+                    job["worker"].kill()
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break